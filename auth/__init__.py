@@ -0,0 +1,3 @@
+from .auth import auth
+
+__all__ = ['auth']
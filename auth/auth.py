@@ -1,8 +1,19 @@
+import asyncio
+import logging
+import time
+
 from database import db
-from config import config
-from telegram import ChatMember
+from config import config, format_phone, is_admin as is_admin_phone
 from telegram.constants import ChatMemberStatus
-import asyncio
+
+logger = logging.getLogger(__name__)
+
+# How long (seconds) a resolved user type is reused; memberships are re-verified after that
+USER_TYPE_CACHE_TTL = 300
+
+# How long (seconds) a user's session row is reused; every session write goes through
+# AuthSystem, which keeps the cached copy in step
+SESSION_CACHE_TTL = 30
 
 
 class AuthSystem:
@@ -19,6 +30,12 @@ class AuthSystem:
     - Graceful handling of permission changes and role transitions
     """
 
+    # user_id -> (monotonic timestamp, formatted phone, resolved user type)
+    _user_type_cache = {}
+
+    # user_id -> (monotonic timestamp, session row or None)
+    _session_cache = {}
+
     @staticmethod
     async def get_user_type(user_id, phone_number, bot):
         """
@@ -39,20 +56,54 @@ class AuthSystem:
             phone_number: User's phone number for database lookups
             bot: Telegram bot instance for making API calls
 
+        Resolved roles are cached per user for USER_TYPE_CACHE_TTL seconds, so a user
+        who comes back with /start is not re-verified against the database and the
+        Telegram API every time. Role-changing writes call invalidate_user_types().
+
         Returns:
             - Single role string ('admin', 'teacher', 'student') for single-role users
             - Dictionary with multiple roles for users with dual permissions
             - None if user has no valid roles
         """
-        formatted_phone = config.format_phone(phone_number)
+        formatted_phone = format_phone(phone_number)
+
+        cached = AuthSystem._user_type_cache.get(user_id)
+        if cached and cached[1] == formatted_phone and time.monotonic() - cached[0] < USER_TYPE_CACHE_TTL:
+            return cached[2]
 
+        user_type = await AuthSystem._resolve_user_type(user_id, formatted_phone, bot)
+        if user_type is not None:
+            # Denials aren't cached, so a user who just joined a channel can retry right away
+            AuthSystem._user_type_cache[user_id] = (time.monotonic(), formatted_phone, user_type)
+        return user_type
+
+    @staticmethod
+    def get_cached_phone(user_id):
+        """Phone number of a user whose roles are still cached, or None"""
+        cached = AuthSystem._user_type_cache.get(user_id)
+        if cached and time.monotonic() - cached[0] < USER_TYPE_CACHE_TTL:
+            return cached[1]
+        return None
+
+    @staticmethod
+    def invalidate_user_types():
+        """
+        Forget every cached user type. Called when teachers or students are added or
+        removed; the cache is keyed by Telegram user id, which those writes don't know.
+        """
+        AuthSystem._user_type_cache.clear()
+
+    @staticmethod
+    async def _resolve_user_type(user_id, formatted_phone, bot):
+        """Determine the user's roles from the database and live group/channel membership"""
         # Initialize role detection flags
-        is_admin = config.is_admin(formatted_phone)
+        is_admin = is_admin_phone(formatted_phone)
         is_teacher = False
         is_student = False
 
         # Verify teacher status through database record and group membership
-        teacher_data = AuthSystem._get_teacher_by_phone(formatted_phone)
+        # (database lookups run on a worker thread so the event loop keeps serving other users)
+        teacher_data = await asyncio.to_thread(AuthSystem._get_teacher_by_phone, formatted_phone)
         if teacher_data:
             # Real-time verification ensures only current faculty members have access
             is_in_teachers_group = await AuthSystem._check_group_membership(
@@ -62,10 +113,10 @@ class AuthSystem:
                 is_teacher = True
 
         # Verify student status through database record and channel membership
-        student_data = AuthSystem._get_student_by_phone(formatted_phone)
+        student_data = await asyncio.to_thread(AuthSystem._get_student_by_phone, formatted_phone)
         if student_data:
             # Students must be active members of their learning group's channel
-            group_data = AuthSystem._get_group_by_id(student_data['group_id'])
+            group_data = await asyncio.to_thread(AuthSystem._get_group_by_id, student_data['group_id'])
             if group_data:
                 is_in_channel = await AuthSystem._check_channel_membership(
                     bot, user_id, group_data['channel_id']
@@ -82,7 +133,7 @@ class AuthSystem:
         elif role_count == 1:
             # Single role scenario - proceed directly to appropriate interface
             if is_admin:
-                AuthSystem._ensure_admin_exists(formatted_phone)
+                await asyncio.to_thread(AuthSystem._ensure_admin_exists, formatted_phone)
                 return 'admin'
             elif is_teacher:
                 return 'teacher'
@@ -92,7 +143,7 @@ class AuthSystem:
             # Multiple roles detected - enable role selection interface
             available_roles = []
             if is_admin:
-                AuthSystem._ensure_admin_exists(formatted_phone)
+                await asyncio.to_thread(AuthSystem._ensure_admin_exists, formatted_phone)
                 available_roles.append('admin')
             if is_teacher:
                 available_roles.append('teacher')
@@ -115,7 +166,7 @@ class AuthSystem:
         """
         try:
             existing_admin = db.execute_query(
-                "SELECT id FROM admins WHERE phone_number = ?",
+                "SELECT 1 FROM admins WHERE phone_number = ? LIMIT 1",
                 (phone_number,)
             )
             if not existing_admin:
@@ -123,49 +174,41 @@ class AuthSystem:
                     "INSERT INTO admins (phone_number) VALUES (?)",
                     (phone_number,)
                 )
-                print(f"Admin record created for {phone_number}")
-        except Exception as e:
-            print(f"Error ensuring admin exists: {e}")
+                logger.info("Admin record created for %s", phone_number)
+        except Exception:
+            # The admin is recognised by phone number alone, so login still works
+            logger.exception("Error ensuring admin exists")
 
     @staticmethod
     def _get_teacher_by_phone(phone_number):
         """
-        Retrieve teacher record by phone number with error resilience.
+        Retrieve teacher record by phone number.
 
         This method provides the foundation for teacher authentication by
-        connecting phone numbers to institutional teacher records. The error
-        handling ensures that authentication continues to function even if
-        database issues occur during the lookup process.
+        connecting phone numbers to institutional teacher records. Database
+        errors propagate, so an outage is reported as an error rather than
+        as "not registered".
         """
-        try:
-            teachers = db.execute_query(
-                "SELECT * FROM teachers WHERE phone_number = ?",
-                (phone_number,)
-            )
-            return teachers[0] if teachers else None
-        except Exception as e:
-            print(f"Error retrieving teacher record: {e}")
-            return None
+        teachers = db.execute_query(
+            "SELECT * FROM teachers WHERE phone_number = ?",
+            (phone_number,)
+        )
+        return teachers[0] if teachers else None
 
     @staticmethod
     def _get_student_by_phone(phone_number):
         """
-        Retrieve student record by phone number with graceful error handling.
+        Retrieve student record by phone number.
 
         Student authentication relies on accurate database lookups that connect
-        phone numbers to learning group memberships. This method ensures that
-        temporary database issues don't prevent legitimate students from
-        accessing their educational resources.
+        phone numbers to learning group memberships. Database errors propagate,
+        so a temporary outage is never mistaken for a student who isn't registered.
         """
-        try:
-            students = db.execute_query(
-                "SELECT * FROM students WHERE phone_number = ?",
-                (phone_number,)
-            )
-            return students[0] if students else None
-        except Exception as e:
-            print(f"Error retrieving student record: {e}")
-            return None
+        students = db.execute_query(
+            "SELECT * FROM students WHERE phone_number = ?",
+            (phone_number,)
+        )
+        return students[0] if students else None
 
     @staticmethod
     def _get_group_by_id(group_id):
@@ -175,17 +218,13 @@ class AuthSystem:
         Learning groups form the organizational backbone of the educational
         system, connecting students to their appropriate learning contexts.
         This method provides the group details needed for channel membership
-        verification and educational workflow management.
+        verification and educational workflow management. Database errors propagate.
         """
-        try:
-            groups = db.execute_query(
-                "SELECT * FROM groups WHERE id = ?",
-                (group_id,)
-            )
-            return groups[0] if groups else None
-        except Exception as e:
-            print(f"Error retrieving group information: {e}")
-            return None
+        groups = db.execute_query(
+            "SELECT * FROM groups WHERE id = ?",
+            (group_id,)
+        )
+        return groups[0] if groups else None
 
     @staticmethod
     async def _check_group_membership(bot, user_id, group_id):
@@ -221,7 +260,7 @@ class AuthSystem:
                 ChatMemberStatus.MEMBER  # Regular group member
             ]
         except Exception as e:
-            print(f"Error verifying group membership: {e}")
+            logger.warning("Error verifying group membership: %s", e)
             # Fail securely - deny access if verification cannot be completed
             return False
 
@@ -258,7 +297,7 @@ class AuthSystem:
                 ChatMemberStatus.MEMBER  # Channel subscriber/member
             ]
         except Exception as e:
-            print(f"Error verifying channel membership: {e}")
+            logger.warning("Error verifying channel membership: %s", e)
             # Secure failure mode - deny access if verification fails
             return False
 
@@ -272,6 +311,9 @@ class AuthSystem:
         ensures that recently created groups appear first, which typically
         corresponds to current semester or term activities.
 
+        Each group row also carries its student_count, computed by a correlated
+        sub-select, so group menus need no separate count queries.
+
         The error handling ensures that temporary database issues don't prevent
         teachers from accessing their group information, maintaining educational
         continuity even during system maintenance periods.
@@ -282,12 +324,16 @@ class AuthSystem:
                 return []
 
             groups = db.execute_query(
-                "SELECT * FROM groups WHERE teacher_id = ? ORDER BY created_at DESC",
+                """SELECT g.*,
+                          (SELECT COUNT(*) FROM students s WHERE s.group_id = g.id) AS student_count
+                   FROM groups g
+                   WHERE g.teacher_id = ?
+                   ORDER BY g.created_at DESC""",
                 (teacher['id'],)
             )
             return groups
-        except Exception as e:
-            print(f"Error retrieving teacher groups: {e}")
+        except Exception:
+            logger.exception("Error retrieving teacher groups")
             return []
 
     @staticmethod
@@ -306,8 +352,8 @@ class AuthSystem:
                 return None
 
             return AuthSystem._get_group_by_id(student['group_id'])
-        except Exception as e:
-            print(f"Error retrieving student group: {e}")
+        except Exception:
+            logger.exception("Error retrieving student group")
             return None
 
     @staticmethod
@@ -333,16 +379,17 @@ class AuthSystem:
             session_type: Activity type ('normal' or 'grading')
         """
         try:
-            # Clear any existing session to prevent context conflicts
-            db.execute_query("DELETE FROM user_sessions WHERE user_id = ?", (user_id,))
-
-            # Establish new session with current timestamp
-            db.execute_query(
-                "INSERT INTO user_sessions (user_id, selected_group_id, session_type) VALUES (?, ?, ?)",
-                (user_id, group_id, session_type)
-            )
-        except Exception as e:
-            print(f"Error establishing user session: {e}")
+            # Replace any existing session in one transaction, so readers never see it missing
+            db.execute_transaction([
+                ("DELETE FROM user_sessions WHERE user_id = ?", (user_id,)),
+                ("INSERT INTO user_sessions (user_id, selected_group_id, session_type) VALUES (?, ?, ?)",
+                 (user_id, group_id, session_type)),
+            ])
+        except Exception:
+            logger.exception("Error establishing user session")
+        finally:
+            # Dropped only after the write: a read racing with it can't re-cache the old row
+            AuthSystem._session_cache.pop(user_id, None)
 
     @staticmethod
     def get_user_session(user_id):
@@ -361,19 +408,39 @@ class AuthSystem:
         Args:
             user_id: Telegram user ID for session lookup
 
+        Lookups are cached for SESSION_CACHE_TTL seconds, since the back button and
+        grade input read the session on nearly every message.
+
         Returns:
             Dictionary containing session details or None if no active session
         """
+        cached = AuthSystem._session_cache.get(user_id)
+        if cached and time.monotonic() - cached[0] < SESSION_CACHE_TTL:
+            return cached[1]
+
         try:
             sessions = db.execute_query(
                 "SELECT * FROM user_sessions WHERE user_id = ?",
                 (user_id,)
             )
-            return sessions[0] if sessions else None
-        except Exception as e:
-            print(f"Error retrieving user session: {e}")
+            session = sessions[0] if sessions else None
+            AuthSystem._session_cache[user_id] = (time.monotonic(), session)
+            return session
+        except Exception:
+            logger.exception("Error retrieving user session")
             return None
 
+    @staticmethod
+    async def get_user_session_async(user_id):
+        """
+        get_user_session for async handlers: a cached session is returned right away,
+        only a cache miss reads the database on a worker thread.
+        """
+        cached = AuthSystem._session_cache.get(user_id)
+        if cached and time.monotonic() - cached[0] < SESSION_CACHE_TTL:
+            return cached[1]
+        return await asyncio.to_thread(AuthSystem.get_user_session, user_id)
+
     @staticmethod
     def clear_user_session(user_id):
         """
@@ -395,8 +462,10 @@ class AuthSystem:
         """
         try:
             db.execute_query("DELETE FROM user_sessions WHERE user_id = ?", (user_id,))
-        except Exception as e:
-            print(f"Error clearing user session: {e}")
+            AuthSystem._session_cache[user_id] = (time.monotonic(), None)
+        except Exception:
+            AuthSystem._session_cache.pop(user_id, None)
+            logger.exception("Error clearing user session")
 
 
 # Create the global authentication instance for system-wide access
@@ -1,10 +1,17 @@
+import logging
 import os
 import json
+import re
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
+# Everything except digits and '+' is stripped from phone numbers
+_PHONE_RE = re.compile(r'[^\d+]')
+
 
 class BotConfig:
     """
@@ -26,6 +33,15 @@ class BotConfig:
     # Database Configuration
     DATABASE_PATH = os.getenv('DATABASE_PATH', 'education_bot.db')  # Default if not specified
 
+    # Conversation states and user_data are saved here so they survive restarts
+    PERSISTENCE_PATH = os.getenv('PERSISTENCE_PATH', 'bot_persistence.pickle')
+
+    # Webhook mode - used instead of long polling when WEBHOOK_URL is set
+    WEBHOOK_URL = os.getenv('WEBHOOK_URL')  # Public HTTPS URL Telegram posts updates to
+    WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')  # Checked against Telegram's secret token header
+    WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+    WEBHOOK_PORT = int(os.getenv('PORT', 8443))
+
     # File Upload Limits - Uses your .env MAX_FILE_UPLOADS setting
     MAX_PHOTOS_PER_TASK = int(os.getenv('MAX_FILE_UPLOADS', 5))
     MAX_PHOTOS_PER_SUBMISSION = int(os.getenv('MAX_FILE_UPLOADS', 5))
@@ -127,97 +143,114 @@ class BotConfig:
         'send_submission_photos': '📸 Ish rasmlarini yuboring:',
     }
 
-    @staticmethod
-    def is_admin(phone_number):
-        """
-        Check if the given phone number belongs to admin.
-        This is the primary admin authentication method using phone verification.
-        """
-        admin_phone = BotConfig.ADMIN_PHONE
-        if not admin_phone:
-            print("WARNING: ADMIN_TEL not set in environment variables!")
-            return False
-        return phone_number == admin_phone
-
-    @staticmethod
-    def format_phone(phone_number):
-        """
-        Standardize phone number format for consistent comparison.
-        This handles different input formats and converts them to international format.
-
-        Examples:
-        - "998901234567" becomes "+998901234567"
-        - "901234567" becomes "+998901234567"
-        - "+998 90 123 45 67" becomes "+998901234567"
-        """
-        # Remove all non-digit characters except +
-        clean_phone = ''.join(c for c in phone_number if c.isdigit() or c == '+')
-
-        # If it doesn't start with +, assume it's local and add +998
-        if not clean_phone.startswith('+'):
-            if clean_phone.startswith('998'):
-                clean_phone = '+' + clean_phone
-            else:
-                clean_phone = '+998' + clean_phone
-
-        return clean_phone
-
-    @staticmethod
-    def photos_to_json(photo_list):
-        """
-        Convert list of photo file_ids to JSON string for database storage.
-        This allows us to store multiple photos efficiently in a single database field.
-        """
-        if not photo_list:
-            return None
-        return json.dumps(photo_list)
-
-    @staticmethod
-    def json_to_photos(json_string):
-        """
-        Convert JSON string back to list of photo file_ids.
-        This retrieves the photo list from database storage for display.
-        """
-        if not json_string:
-            return []
-        try:
-            return json.loads(json_string)
-        except:
-            return []
-
-    @staticmethod
-    def get_queue_position_text(position):
-        """
-        Get user-friendly queue position text in Uzbek.
-        This provides encouraging feedback to students about their submission status.
-        """
-        if position == 1:
-            return "Sizning ishingiz keyingi navbatda!"
+
+def is_admin(phone_number):
+    """
+    Check if the given phone number belongs to admin.
+    This is the primary admin authentication method using phone verification.
+    """
+    if not ADMIN_PHONE_NORMALIZED:
+        logger.warning("ADMIN_TEL not set in environment variables!")
+        return False
+    return format_phone(phone_number) == ADMIN_PHONE_NORMALIZED
+
+
+def format_phone(phone_number):
+    """
+    Standardize phone number format for consistent comparison.
+    This handles different input formats and converts them to international format.
+
+    Examples:
+    - "998901234567" becomes "+998901234567"
+    - "901234567" becomes "+998901234567"
+    - "+998 90 123 45 67" becomes "+998901234567"
+    """
+    # Remove all non-digit characters except +
+    clean_phone = _PHONE_RE.sub('', phone_number)
+
+    # If it doesn't start with +, assume it's local and add +998
+    if not clean_phone.startswith('+'):
+        if clean_phone.startswith('998'):
+            clean_phone = '+' + clean_phone
         else:
-            return f"Sizning navbatingiz: {position}"
-
-    @staticmethod
-    def validate_configuration():
-        """
-        Validate that all required environment variables are set.
-        This helps catch configuration errors early during startup.
-        """
-        required_vars = {
-            'BOT_TOKEN': BotConfig.BOT_TOKEN,
-            'ADMIN_TEL': BotConfig.ADMIN_PHONE,
-            'TEACHER_GROUP_ID': BotConfig.TEACHERS_GROUP_ID
-        }
-
-        missing_vars = [var for var, value in required_vars.items() if not value]
-
-        if missing_vars:
-            print(f"❌ Missing required environment variables: {', '.join(missing_vars)}")
-            print("Please check your .env file and ensure all required variables are set.")
-            return False
-
-        print("✅ Configuration validation passed!")
-        return True
+            clean_phone = '+998' + clean_phone
+
+    return clean_phone
+
+
+# Admin phone normalized once at startup so admin checks are a plain string comparison
+ADMIN_PHONE_NORMALIZED = format_phone(BotConfig.ADMIN_PHONE) if BotConfig.ADMIN_PHONE else None
+
+
+# Separator between photo file_ids in the database (ASCII unit separator, never part of a file_id)
+PHOTO_SEPARATOR = '\x1f'
+
+
+def photos_to_json(photo_list):
+    """
+    Convert list of photo file_ids to a string for database storage.
+    The ids are joined with PHOTO_SEPARATOR, so reading them back is a single split.
+    """
+    if not photo_list:
+        return None
+    return PHOTO_SEPARATOR.join(photo_list)
+
+
+def json_to_photos(json_string):
+    """
+    Convert a stored photo string back to list of photo file_ids.
+    Rows written before the separator format still hold a JSON array and are parsed as such.
+    """
+    if not json_string:
+        return []
+    if json_string[0] != '[':
+        return json_string.split(PHOTO_SEPARATOR)
+    try:
+        return json.loads(json_string)
+    except:
+        return []
+
+
+# Precomputed queue texts for the realistic range of positions (1-100)
+_QUEUE_TEXTS = ("Sizning ishingiz keyingi navbatda!",) + tuple(
+    f"Sizning navbatingiz: {i}" for i in range(2, 101)
+)
+
+
+def get_queue_position_text(position):
+    """
+    Get user-friendly queue position text in Uzbek.
+    This provides encouraging feedback to students about their submission status.
+    """
+    if 1 <= position <= len(_QUEUE_TEXTS):
+        return _QUEUE_TEXTS[position - 1]
+    return f"Sizning navbatingiz: {position}"
+
+
+def validate_configuration():
+    """
+    Validate that all required environment variables are set.
+    This helps catch configuration errors early during startup.
+    """
+    required_vars = {
+        'BOT_TOKEN': BotConfig.BOT_TOKEN,
+        'ADMIN_TEL': BotConfig.ADMIN_PHONE,
+        'TEACHER_GROUP_ID': BotConfig.TEACHERS_GROUP_ID
+    }
+
+    missing_vars = [var for var, value in required_vars.items() if not value]
+
+    if missing_vars:
+        logger.error("❌ Missing required environment variables: %s", ', '.join(missing_vars))
+        logger.error("Please check your .env file and ensure all required variables are set.")
+        return False
+
+    logger.info("✅ Configuration validation passed!")
+    return True
+
 
+# Kept for backward compatibility with callers using config.is_admin(...)
+BotConfig.is_admin = staticmethod(is_admin)
 
 # Create a global config instance for easy import across the application
 config = BotConfig()
\ No newline at end of file
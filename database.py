@@ -1,46 +1,94 @@
+import asyncio
+import logging
 import sqlite3
-import os
+import threading
 from datetime import datetime, timezone
 
+# Bump whenever the schema below changes so existing databases get upgraded
+SCHEMA_VERSION = 6
+
+logger = logging.getLogger(__name__)
+
 
 class Database:
     def __init__(self, db_path="education_bot.db"):
-        """Initialize database connection and create tables if they don't exist"""
+        """
+        Set up the database handle. Tables are created by init_database(), which the
+        bot runs once at startup (Application.post_init) rather than at import time.
+        """
         self.db_path = db_path
-        self.init_database()
+        self._local = threading.local()  # One long-lived query connection per thread
+        # Every such connection, so close() can optimize and close them at shutdown
+        self._thread_connections = []
+        self._thread_connections_lock = threading.Lock()
+
+        # init_database() does its work once per process, however often it is called
+        self._init_lock = threading.Lock()
+        self._initialized = False
 
-    def get_connection(self):
+    def get_connection(self, check_same_thread=True):
         """Get database connection with foreign key support enabled"""
-        conn = sqlite3.connect(self.db_path)
+        conn = sqlite3.connect(self.db_path, cached_statements=128, check_same_thread=check_same_thread)
         conn.execute("PRAGMA foreign_keys = ON")  # Enable foreign key constraints
+        conn.execute("PRAGMA synchronous = NORMAL")  # Safe with WAL, far fewer fsyncs
+        conn.execute("PRAGMA cache_size = -20000")  # ~20MB page cache
+        conn.execute("PRAGMA mmap_size = 268435456")  # Memory-map up to 256MB
+        conn.execute("PRAGMA temp_store = MEMORY")
         conn.row_factory = sqlite3.Row  # This allows us to access columns by name
         return conn
 
+    def _thread_connection(self):
+        """
+        Connection reused by every query issued from the current thread.
+        Keeping it open keeps its prepared-statement cache warm across calls.
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # Only this thread uses it until close(), which runs once the bot has stopped
+            conn = self.get_connection(check_same_thread=False)
+            self._local.conn = conn
+            with self._thread_connections_lock:
+                self._thread_connections.append(conn)
+        return conn
+
     def init_database(self):
-        """Create all necessary tables with proper relationships"""
+        """Create all necessary tables with proper relationships (once per process)"""
+        with self._init_lock:
+            if not self._initialized:
+                self._initialized = self._create_schema()
+
+    def _create_schema(self):
+        """Create or upgrade the schema; returns True once the database is up to date"""
         conn = self.get_connection()
 
         try:
-            # Admin table - simple static phone number storage
-            conn.execute('''
+            # WAL lets readers continue while a write is in progress (persists in the file)
+            conn.execute("PRAGMA journal_mode = WAL")
+
+            # Skip schema creation when the database is already up to date
+            current_version = conn.execute("PRAGMA user_version").fetchone()[0]
+            if current_version >= SCHEMA_VERSION:
+                return True
+
+            # Create every table and index in one script and one transaction (single commit)
+            conn.executescript(f'''
+                BEGIN;
+
+                -- Admin table - simple static phone number storage
                 CREATE TABLE IF NOT EXISTS admins (
                     id INTEGER PRIMARY KEY,
                     phone_number TEXT UNIQUE NOT NULL
-                )
-            ''')
+                );
 
-            # Teachers table - stores teacher info created by admin
-            conn.execute('''
+                -- Teachers table - stores teacher info created by admin
                 CREATE TABLE IF NOT EXISTS teachers (
                     id INTEGER PRIMARY KEY,
                     phone_number TEXT UNIQUE NOT NULL,
                     fullname TEXT NOT NULL,
                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
+                );
 
-            # Groups table - each group belongs to a teacher and has a telegram channel
-            conn.execute('''
+                -- Groups table - each group belongs to a teacher and has a telegram channel
                 CREATE TABLE IF NOT EXISTS groups (
                     id INTEGER PRIMARY KEY,
                     name TEXT NOT NULL,
@@ -48,11 +96,9 @@ class Database:
                     teacher_id INTEGER NOT NULL,
                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                     FOREIGN KEY (teacher_id) REFERENCES teachers (id) ON DELETE CASCADE
-                )
-            ''')
+                );
 
-            # Modules table - each group has multiple modules, auto incrementing
-            conn.execute('''
+                -- Modules table - each group has multiple modules, auto incrementing
                 CREATE TABLE IF NOT EXISTS modules (
                     id INTEGER PRIMARY KEY,
                     group_id INTEGER NOT NULL,
@@ -60,24 +106,20 @@ class Database:
                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                     FOREIGN KEY (group_id) REFERENCES groups (id) ON DELETE CASCADE,
                     UNIQUE(group_id, module_number)  -- Each module number unique per group
-                )
-            ''')
+                );
 
-            # Tasks table - each module can have multiple tasks, but only one active per group
-            conn.execute('''
+                -- Tasks table - each module can have multiple tasks, but only one active per group
                 CREATE TABLE IF NOT EXISTS tasks (
                     id INTEGER PRIMARY KEY,
                     module_id INTEGER NOT NULL,
                     description TEXT NOT NULL,
-                    photos TEXT,  -- JSON string of photo file_ids
+                    photos TEXT,  -- photo file_ids, encoded by config.photos_to_json
                     is_active BOOLEAN DEFAULT TRUE,
                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                     FOREIGN KEY (module_id) REFERENCES modules (id) ON DELETE CASCADE
-                )
-            ''')
+                );
 
-            # Students table - belongs to a group, must be in telegram channel
-            conn.execute('''
+                -- Students table - belongs to a group, must be in telegram channel
                 CREATE TABLE IF NOT EXISTS students (
                     id INTEGER PRIMARY KEY,
                     phone_number TEXT NOT NULL,
@@ -86,27 +128,23 @@ class Database:
                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                     FOREIGN KEY (group_id) REFERENCES groups (id) ON DELETE CASCADE,
                     UNIQUE(phone_number, group_id)  -- Student can be in multiple groups
-                )
-            ''')
+                );
 
-            # Submissions table - student submissions for tasks
-            conn.execute('''
+                -- Submissions table - student submissions for tasks
                 CREATE TABLE IF NOT EXISTS submissions (
                     id INTEGER PRIMARY KEY,
                     task_id INTEGER NOT NULL,
                     student_id INTEGER NOT NULL,
-                    photos TEXT,  -- JSON string of photo file_ids
+                    photos TEXT,  -- photo file_ids, encoded by config.photos_to_json
                     description TEXT,
                     submitted_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                     is_graded BOOLEAN DEFAULT FALSE,
                     FOREIGN KEY (task_id) REFERENCES tasks (id) ON DELETE CASCADE,
                     FOREIGN KEY (student_id) REFERENCES students (id) ON DELETE CASCADE,
                     UNIQUE(task_id, student_id)  -- One submission per task per student
-                )
-            ''')
+                );
 
-            # Grades table - teacher grades for submissions, stored per module
-            conn.execute('''
+                -- Grades table - teacher grades for submissions, stored per module
                 CREATE TABLE IF NOT EXISTS grades (
                     id INTEGER PRIMARY KEY,
                     submission_id INTEGER NOT NULL,
@@ -118,52 +156,146 @@ class Database:
                     FOREIGN KEY (module_id) REFERENCES modules (id) ON DELETE CASCADE,
                     FOREIGN KEY (student_id) REFERENCES students (id) ON DELETE CASCADE,
                     UNIQUE(submission_id)  -- One grade per submission
-                )
-            ''')
+                );
 
-            # User sessions table - to track current selected group for teachers
-            conn.execute('''
+                -- User sessions table - to track current selected group for teachers
                 CREATE TABLE IF NOT EXISTS user_sessions (
                     user_id INTEGER PRIMARY KEY,
                     selected_group_id INTEGER,
                     session_type TEXT,  -- 'grading', 'normal'
                     updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                     FOREIGN KEY (selected_group_id) REFERENCES groups (id) ON DELETE SET NULL
-                )
+                );
+
+                -- Covering indexes for the admin teacher listings (ordered by date / by name)
+                CREATE INDEX IF NOT EXISTS idx_teachers_created_at
+                    ON teachers (created_at DESC, fullname, phone_number);
+                CREATE INDEX IF NOT EXISTS idx_teachers_fullname
+                    ON teachers (fullname, phone_number);
+
+                -- Indexes for the student-facing lookups: active task per module, grading
+                -- queue order, latest grade per student and the per-module leaderboard
+                CREATE INDEX IF NOT EXISTS idx_tasks_module_active
+                    ON tasks (module_id, is_active, created_at DESC);
+                CREATE INDEX IF NOT EXISTS idx_submissions_queue
+                    ON submissions (is_graded, submitted_at);
+                CREATE INDEX IF NOT EXISTS idx_grades_student_time
+                    ON grades (student_id, graded_at DESC);
+                CREATE INDEX IF NOT EXISTS idx_grades_module_score
+                    ON grades (module_id, score DESC, graded_at ASC);
+
+                -- Per-group student counts (the UNIQUE index leads with phone_number)
+                CREATE INDEX IF NOT EXISTS idx_students_group
+                    ON students (group_id);
+
+                -- A teacher's groups, newest first
+                CREATE INDEX IF NOT EXISTS idx_groups_teacher
+                    ON groups (teacher_id, created_at DESC);
+
+                -- Rewrite photo lists still stored as JSON arrays into the separator format
+                -- (malformed values are left alone; json_to_photos reads them as no photos)
+                UPDATE tasks
+                SET photos = (SELECT group_concat(value, char(31)) FROM json_each(tasks.photos))
+                WHERE photos LIKE '[%' AND json_valid(photos);
+                UPDATE submissions
+                SET photos = (SELECT group_concat(value, char(31)) FROM json_each(submissions.photos))
+                WHERE photos LIKE '[%' AND json_valid(photos);
+
+                PRAGMA user_version = {SCHEMA_VERSION};
+                COMMIT;
             ''')
 
-            conn.commit()
-            print("Database initialized successfully!")
+            # Seed sqlite_stat1 right after schema (and index) changes
+            conn.execute("ANALYZE")
+            logger.info("Database initialized successfully!")
+            return True
 
         except Exception as e:
-            print(f"Error initializing database: {e}")
+            logger.error("Error initializing database: %s", e)
             conn.rollback()
+            return False
         finally:
             conn.close()
 
     def execute_query(self, query, params=None):
         """Execute a query and return results"""
-        conn = self.get_connection()
+        conn = self._thread_connection()
         try:
             if params:
                 cursor = conn.execute(query, params)
             else:
                 cursor = conn.execute(query)
 
-            # If it's a SELECT query, fetch results
-            if query.strip().upper().startswith('SELECT'):
+            # If it's a SELECT query (plain or with a WITH clause), fetch results
+            if query.strip().upper().startswith(('SELECT', 'WITH')):
                 results = cursor.fetchall()
                 return [dict(row) for row in results]
             else:
-                # For INSERT, UPDATE, DELETE operations
+                # For INSERT, UPDATE, DELETE operations; RETURNING rows come back as dicts
+                returned = cursor.fetchall() if cursor.description else None
                 conn.commit()
+                if returned is not None:
+                    return [dict(row) for row in returned]
                 return cursor.lastrowid
 
         except Exception as e:
             conn.rollback()
             raise e
-        finally:
-            conn.close()
+
+    def execute_transaction(self, statements):
+        """
+        Run several (query, params) statements atomically on one connection.
+        Returns what the last statement produced: its rows as dicts, or lastrowid.
+        The write lock is taken up front (BEGIN IMMEDIATE) so the transaction never
+        has to upgrade a read lock midway.
+        """
+        if not statements:
+            raise ValueError("execute_transaction needs at least one statement")
+
+        conn = self._thread_connection()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for query, params in statements:
+                cursor = conn.execute(query, params or ())
+            returned = cursor.fetchall() if cursor.description else None
+            conn.commit()
+
+            if returned is not None:
+                return [dict(row) for row in returned]
+            return cursor.lastrowid
+
+        except Exception as e:
+            conn.rollback()
+            raise e
+
+    async def execute_transaction_async(self, statements):
+        """execute_transaction on a worker thread, like execute_query_async"""
+        return await asyncio.to_thread(self.execute_transaction, statements)
+
+    async def execute_query_async(self, query, params=None):
+        """
+        Run execute_query on a worker thread so the bot's event loop keeps serving
+        other users while SQLite works. Each worker thread uses its own connection,
+        so concurrent calls are safe; SQLite itself serializes the writes.
+        """
+        return await asyncio.to_thread(self.execute_query, query, params)
+
+    def close(self):
+        """
+        Optimize and close the per-thread query connections; called once at shutdown.
+        PRAGMA optimize only looks at tables its own connection has queried, so it has to run
+        on these long-lived connections - a fresh one would have nothing to analyze.
+        """
+        with self._thread_connections_lock:
+            connections, self._thread_connections = self._thread_connections, []
+
+        for conn in connections:
+            try:
+                conn.execute("PRAGMA optimize")
+            except sqlite3.Error as e:
+                logger.error("Error optimizing database: %s", e)
+            finally:
+                conn.close()
 
     def get_utc_now(self):
         """Get current UTC timestamp for consistent time handling"""
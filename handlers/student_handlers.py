@@ -1,12 +1,88 @@
+import asyncio
+import logging
+import time
+
 from telegram import Update, ReplyKeyboardMarkup, KeyboardButton
 from telegram.ext import ContextTypes, ConversationHandler
 from database import db
-from config import config
+from config import config, photos_to_json, json_to_photos, get_queue_position_text
 from auth import auth
+from media import send_photos, truncate
+
+logger = logging.getLogger(__name__)
 
 # Conversation states for student interactions
 WAITING_SUBMISSION_DESCRIPTION, WAITING_SUBMISSION_PHOTOS = range(2)
 
+# How long (seconds) an active-task lookup is reused before hitting the database again
+ACTIVE_TASK_CACHE_TTL = 60
+
+# How long (seconds) a group's leaderboard ranking is reused between grade changes
+LEADERBOARD_CACHE_TTL = 30
+
+# Grade emoji indexed directly by score (0-100): <60, 60s, 70s, 80s, 90+
+_GRADE_EMOJI = ("📈",) * 60 + ("👍",) * 10 + ("✅",) * 10 + ("⭐",) * 10 + ("🌟",) * 11
+
+# Medal emoji for the leaderboard podium; other positions are shown as "N."
+_POSITION_EMOJI = {1: "🥇", 2: "🥈", 3: "🥉"}
+
+# Message templates filled with str.format on each render
+_TASK_DETAILS_TEMPLATE = (
+    "📋 Joriy Vazifa\n"
+    "📖 Modul: #{module_number}\n"
+    "📅 Berilgan: {created_at}\n\n"
+    "📝 Vazifa tavsifi:\n{description}\n\n"
+    "💡 Ishingizni topshirish uchun tugmani bosing!"
+)
+
+_PROGRESS_TEMPLATE = (
+    "📊 Sizning natijalaringiz\n\n"
+    "👤 Ism: {name}\n"
+    "📚 Guruh: {group}\n\n"
+    "📈 Umumiy statistika:\n"
+    "• Eng so'nggi baho: {latest_score}/100 (Modul #{latest_module})\n"
+    "• O'rtacha baho: {average:.1f}/100\n"
+    "• Eng yuqori baho: {highest}/100\n"
+    "• Jami baholangan modullar: {count}\n\n"
+    "📋 Modullar bo'yicha tarix:\n"
+)
+
+_LEADERBOARD_HEADER_TEMPLATE = (
+    "🏆 Guruh reytinglari\n"
+    "📚 Guruh: {group}\n"
+    "📖 Modul: #{module_number}\n\n"
+)
+
+# Keyboards that never change are built once at import time
+_STUDENT_MENU_MARKUP = ReplyKeyboardMarkup(
+    [
+        [KeyboardButton(config.BUTTONS['current_task'])],
+        [KeyboardButton(config.BUTTONS['my_progress'])],
+        [KeyboardButton(config.BUTTONS['leaderboard'])]
+    ],
+    resize_keyboard=True,
+    one_time_keyboard=False
+)
+
+_SUBMIT_MARKUP = ReplyKeyboardMarkup(
+    [[KeyboardButton(config.BUTTONS['submit_task'])]],
+    resize_keyboard=True,
+    one_time_keyboard=True
+)
+
+_DONE_OR_CANCEL_MARKUP = ReplyKeyboardMarkup(
+    [[KeyboardButton(config.BUTTONS['done'])],
+     [KeyboardButton(config.BUTTONS['cancel'])]],
+    resize_keyboard=True,
+    one_time_keyboard=True
+)
+
+_CANCEL_MARKUP = ReplyKeyboardMarkup(
+    [[KeyboardButton(config.BUTTONS['cancel'])]],
+    resize_keyboard=True,
+    one_time_keyboard=True
+)
+
 
 class StudentHandlers:
     """
@@ -25,28 +101,22 @@ class StudentHandlers:
     4. Track progress and compare with peers (leaderboard)
     """
 
+    # group_id -> (monotonic timestamp, active task row or None)
+    _active_task_cache = {}
+
+    # group_id -> (monotonic timestamp, ranked leaderboard rows)
+    _leaderboard_cache = {}
+
     @staticmethod
     async def show_student_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
         """
         Display the main student learning dashboard.
         This is designed to be simple and focused on the core student activities.
         """
-        keyboard = [
-            [KeyboardButton(config.BUTTONS['current_task'])],
-            [KeyboardButton(config.BUTTONS['my_progress'])],
-            [KeyboardButton(config.BUTTONS['leaderboard'])]
-        ]
-
-        reply_markup = ReplyKeyboardMarkup(
-            keyboard,
-            resize_keyboard=True,
-            one_time_keyboard=False
-        )
-
         await update.message.reply_text(
             "👨‍🎓 Talaba Paneli\n\n"
             "O'rganish jarayonini kuzatish uchun quyidagilardan birini tanlang:",
-            reply_markup=reply_markup
+            reply_markup=_STUDENT_MENU_MARKUP
         )
 
     @staticmethod
@@ -59,19 +129,23 @@ class StudentHandlers:
         """
         try:
             # Get student's group information
-            student_phone = context.user_data.get('user_phone')
-            student_group = auth.get_student_group(student_phone)
+            student = await StudentHandlers._student(context)
+            student_group = await StudentHandlers._group(context)
 
             if not student_group:
                 await update.message.reply_text("❌ Guruh ma'lumotlari topilmadi.")
                 return
 
-            # Find the current active task for this group
-            active_task = StudentHandlers._get_active_task(student_group['id'])
+            # Active task (with the student's submission, grade and module number) and the
+            # grading queue position are independent reads, so they run concurrently
+            task, queue_position = await asyncio.gather(
+                StudentHandlers._get_task_context(student_group['id'], student['id']),
+                StudentHandlers._get_queue_position(student['id'], student_group['id'])
+            )
 
-            if not active_task:
+            if not task:
                 # No active task - show encouragement and latest grade
-                latest_grade = StudentHandlers._get_latest_grade(student_phone)
+                latest_grade = await StudentHandlers._get_latest_grade(student['id'])
                 if latest_grade:
                     await update.message.reply_text(
                         f"🎉 Hozirda faol vazifa yo'q!\n\n"
@@ -83,37 +157,31 @@ class StudentHandlers:
                     await update.message.reply_text(config.MESSAGES['no_active_task'])
                 return
 
-            # Check if student has already submitted for this task
-            student = auth._get_student_by_phone(student_phone)
-            existing_submission = StudentHandlers._get_student_submission(active_task['id'], student['id'])
-
-            if existing_submission:
+            if task['submission_id']:
                 # Student has already submitted - show status
-                if existing_submission['is_graded']:
+                if task['is_graded']:
                     # Show the grade
-                    grade = StudentHandlers._get_submission_grade(existing_submission['id'])
                     await update.message.reply_text(
                         f"✅ Siz bu vazifani allaqachon topshirgansiz va baholangansiz!\n\n"
-                        f"📊 Bahoyingiz: {grade['score']}/100\n"
-                        f"📅 Topshirilgan: {existing_submission['submitted_at'][:16]}\n"
-                        f"📅 Baholangan: {grade['graded_at'][:16] if grade else 'Nomalum'}"
+                        f"📊 Bahoyingiz: {task['score']}/100\n"
+                        f"📅 Topshirilgan: {task['submitted_at'][:16]}\n"
+                        f"📅 Baholangan: {task['graded_at'][:16] if task['graded_at'] else 'Nomalum'}"
                     )
                 else:
                     # Show queue position
-                    queue_position = StudentHandlers._get_queue_position(student['id'], student_group['id'])
                     await update.message.reply_text(
                         f"⏳ Sizning ishingiz tekshirilmoqda...\n\n"
-                        f"📋 Vazifa: {active_task['description'][:100]}{'...' if len(active_task['description']) > 100 else ''}\n"
-                        f"📅 Topshirilgan: {existing_submission['submitted_at'][:16]}\n\n"
-                        f"{config.get_queue_position_text(queue_position)}\n"
+                        f"📋 Vazifa: {truncate(task['description'])}\n"
+                        f"📅 Topshirilgan: {task['submitted_at'][:16]}\n\n"
+                        f"{get_queue_position_text(queue_position)}\n"
                         f"O'qituvchi tez orada bahoyingizni qo'yadi."
                     )
             else:
                 # Student hasn't submitted yet - show task and submit button
-                await StudentHandlers._show_task_details(update, context, active_task)
+                await StudentHandlers._show_task_details(update, context, task)
 
-        except Exception as e:
-            print(f"Error showing current task: {e}")
+        except Exception:
+            logger.exception("Error showing current task")
             await update.message.reply_text(config.MESSAGES['something_wrong'])
 
     @staticmethod
@@ -122,39 +190,18 @@ class StudentHandlers:
         Display detailed task information with submission option.
         This presentation should inspire and guide students toward successful completion.
         """
-        # Get module information for context
-        module_info = db.execute_query(
-            "SELECT module_number FROM modules WHERE id = ?",
-            (task['module_id'],)
-        )[0]
-
-        # Build the task display message
-        message = (
-            f"📋 Joriy Vazifa\n"
-            f"📖 Modul: #{module_info['module_number']}\n"
-            f"📅 Berilgan: {task['created_at'][:16]}\n\n"
-            f"📝 Vazifa tavsifi:\n{task['description']}\n\n"
-            f"💡 Ishingizni topshirish uchun tugmani bosing!"
+        # Build the task display message (module number comes with the task row)
+        message = _TASK_DETAILS_TEMPLATE.format(
+            module_number=task['module_number'],
+            created_at=task['created_at'][:16],
+            description=task['description']
         )
 
-        # Send task photos if available to provide visual context
-        photos = config.json_to_photos(task['photos'])
-        if photos:
-            for photo_id in photos:
-                await update.message.bot.send_photo(
-                    chat_id=update.effective_chat.id,
-                    photo=photo_id
-                )
-
-        # Create submit button
-        keyboard = [[KeyboardButton(config.BUTTONS['submit_task'])]]
-        reply_markup = ReplyKeyboardMarkup(
-            keyboard,
-            resize_keyboard=True,
-            one_time_keyboard=True
-        )
+        # Send task photos if available to provide visual context.
+        # Albums carry 2-10 photos, so photos go out in one request per 10 instead of one each
+        await send_photos(update.message.bot, update.effective_chat.id, json_to_photos(task['photos']))
 
-        await update.message.reply_text(message, reply_markup=reply_markup)
+        await update.message.reply_text(message, reply_markup=_SUBMIT_MARKUP)
 
     @staticmethod
     async def start_submit_task(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -164,17 +211,16 @@ class StudentHandlers:
         demonstrate their understanding and effort.
         """
         try:
-            student_phone = context.user_data.get('user_phone')
-            student_group = auth.get_student_group(student_phone)
-            active_task = StudentHandlers._get_active_task(student_group['id'])
+            student_group = await StudentHandlers._group(context)
+            active_task = await StudentHandlers._get_active_task(student_group['id'])
 
             if not active_task:
                 await update.message.reply_text(config.MESSAGES['no_active_task'])
                 return ConversationHandler.END
 
             # Check if already submitted
-            student = auth._get_student_by_phone(student_phone)
-            existing_submission = StudentHandlers._get_student_submission(active_task['id'], student['id'])
+            student = await StudentHandlers._student(context)
+            existing_submission = await StudentHandlers._get_student_submission(active_task['id'], student['id'])
 
             if existing_submission:
                 await update.message.reply_text(config.MESSAGES['already_submitted'])
@@ -190,8 +236,8 @@ class StudentHandlers:
 
             return WAITING_SUBMISSION_DESCRIPTION
 
-        except Exception as e:
-            print(f"Error starting task submission: {e}")
+        except Exception:
+            logger.exception("Error starting task submission")
             await update.message.reply_text(config.MESSAGES['something_wrong'])
             return ConversationHandler.END
 
@@ -212,11 +258,7 @@ class StudentHandlers:
 
         await update.message.reply_text(
             config.MESSAGES['send_submission_photos'],
-            reply_markup=ReplyKeyboardMarkup(
-                [[KeyboardButton(config.BUTTONS['done'])],
-                 [KeyboardButton(config.BUTTONS['cancel'])]],
-                resize_keyboard=True, one_time_keyboard=True
-            )
+            reply_markup=_DONE_OR_CANCEL_MARKUP
         )
 
         # Initialize photos list
@@ -267,8 +309,8 @@ class StudentHandlers:
 
                 return WAITING_SUBMISSION_PHOTOS
 
-        except Exception as e:
-            print(f"Error handling submission photos: {e}")
+        except Exception:
+            logger.exception("Error handling submission photos")
             await update.message.reply_text(config.MESSAGES['something_wrong'])
             return ConversationHandler.END
 
@@ -279,29 +321,41 @@ class StudentHandlers:
         This marks a completed learning cycle for the student.
         """
         try:
-            student_phone = context.user_data.get('user_phone')
-            student = auth._get_student_by_phone(student_phone)
+            student = await StudentHandlers._student(context)
 
             task = context.user_data.get('submitting_task')
             description = context.user_data.get('submission_description')
             photos = context.user_data.get('submission_photos', [])
 
-            # Create the submission record
-            submission_id = db.execute_query(
-                "INSERT INTO submissions (task_id, student_id, description, photos) VALUES (?, ?, ?, ?)",
-                (task['id'], student['id'], description, config.photos_to_json(photos))
-            )
-
-            # Get queue position for feedback to student
-            student_group = auth.get_student_group(student_phone)
-            queue_position = StudentHandlers._get_queue_position(student['id'], student_group['id'])
+            student_group = await StudentHandlers._group(context)
+
+            # Create the submission record and count the ungraded work queued up to and
+            # including it (same order as _get_queue_position) in one transaction
+            result = await db.execute_transaction_async([
+                (
+                    "INSERT INTO submissions (task_id, student_id, description, photos) VALUES (?, ?, ?, ?)",
+                    (task['id'], student['id'], description, photos_to_json(photos))
+                ),
+                (
+                    """SELECT COUNT(*) AS position
+                       FROM submissions s
+                       JOIN tasks t ON s.task_id = t.id
+                       JOIN modules m ON t.module_id = m.id
+                       JOIN submissions mine ON mine.id = last_insert_rowid()
+                       WHERE m.group_id = ? AND s.is_graded = FALSE
+                         AND (s.submitted_at < mine.submitted_at
+                              OR (s.submitted_at = mine.submitted_at AND s.id <= mine.id))""",
+                    (student_group['id'],)
+                )
+            ])
+            queue_position = result[0]['position']
 
             await update.message.reply_text(
                 f"✅ Ishingiz muvaffaqiyatli topshirildi!\n\n"
-                f"📋 Vazifa: {task['description'][:50]}{'...' if len(task['description']) > 50 else ''}\n"
-                f"💬 Sizning izohi: {description[:50]}{'...' if len(description) > 50 else ''}\n"
+                f"📋 Vazifa: {truncate(task['description'], 50)}\n"
+                f"💬 Sizning izohi: {truncate(description, 50)}\n"
                 f"📸 Rasmlar soni: {len(photos)}\n\n"
-                f"{config.get_queue_position_text(queue_position)}\n"
+                f"{get_queue_position_text(queue_position)}\n"
                 f"O'qituvchi tez orada bahoyingizni qo'yadi. 📊"
             )
 
@@ -310,8 +364,8 @@ class StudentHandlers:
             context.user_data.pop('submission_description', None)
             context.user_data.pop('submission_photos', None)
 
-        except Exception as e:
-            print(f"Error finalizing submission: {e}")
+        except Exception:
+            logger.exception("Error finalizing submission")
             await update.message.reply_text(config.MESSAGES['something_wrong'])
 
     @staticmethod
@@ -321,17 +375,19 @@ class StudentHandlers:
         Progress tracking is essential for motivation and self-assessment.
         """
         try:
-            student_phone = context.user_data.get('user_phone')
-            student = auth._get_student_by_phone(student_phone)
-            student_group = auth.get_student_group(student_phone)
+            student = await StudentHandlers._student(context)
+            student_group = await StudentHandlers._group(context)
 
             if not student or not student_group:
                 await update.message.reply_text("❌ Talaba ma'lumotlari topilmadi.")
                 return
 
-            # Get all grades for this student
-            grades = db.execute_query(
-                """SELECT g.*, m.module_number 
+            # Get all grades for this student; the window aggregates repeat the totals on every row
+            grades = await db.execute_query_async(
+                """SELECT g.score, m.module_number,
+                          AVG(g.score) OVER () AS average_score,
+                          MAX(g.score) OVER () AS highest_score,
+                          COUNT(*) OVER () AS graded_count
                    FROM grades g
                    JOIN modules m ON g.module_id = m.id
                    WHERE g.student_id = ?
@@ -349,34 +405,30 @@ class StudentHandlers:
                 )
                 return
 
-            # Calculate statistics
+            # Statistics are computed by SQLite
             latest_grade = grades[0]  # Most recent module
-            total_score = sum(grade['score'] for grade in grades)
-            average_score = total_score / len(grades)
-            highest_score = max(grade['score'] for grade in grades)
-
-            # Build progress message
-            message = (
-                f"📊 Sizning natijalaringiz\n\n"
-                f"👤 Ism: {student['fullname']}\n"
-                f"📚 Guruh: {student_group['name']}\n\n"
-                f"📈 Umumiy statistika:\n"
-                f"• Eng so'nggi baho: {latest_grade['score']}/100 (Modul #{latest_grade['module_number']})\n"
-                f"• O'rtacha baho: {average_score:.1f}/100\n"
-                f"• Eng yuqori baho: {highest_score}/100\n"
-                f"• Jami baholangan modullar: {len(grades)}\n\n"
-                f"📋 Modullar bo'yicha tarix:\n"
-            )
+
+            # Build progress message from parts, joined once at the end
+            parts = [_PROGRESS_TEMPLATE.format(
+                name=student['fullname'],
+                group=student_group['name'],
+                latest_score=latest_grade['score'],
+                latest_module=latest_grade['module_number'],
+                average=latest_grade['average_score'],
+                highest=latest_grade['highest_score'],
+                count=latest_grade['graded_count']
+            )]
 
             # Show each module's grade
             for grade in grades:
                 grade_emoji = StudentHandlers._get_grade_emoji(grade['score'])
-                message += f"• Modul #{grade['module_number']}: {grade['score']}/100 {grade_emoji}\n"
+                parts.append(f"• Modul #{grade['module_number']}: {grade['score']}/100 {grade_emoji}\n")
 
+            message = "".join(parts)
             await update.message.reply_text(message)
 
-        except Exception as e:
-            print(f"Error showing student progress: {e}")
+        except Exception:
+            logger.exception("Error showing student progress")
             await update.message.reply_text(config.MESSAGES['something_wrong'])
 
     @staticmethod
@@ -386,34 +438,19 @@ class StudentHandlers:
         Social comparison can be a powerful motivator when done positively.
         """
         try:
-            student_phone = context.user_data.get('user_phone')
-            student = auth._get_student_by_phone(student_phone)
-            student_group = auth.get_student_group(student_phone)
+            student = await StudentHandlers._student(context)
+            student_group = await StudentHandlers._group(context)
 
-            # Get latest module number for this group
-            latest_module = db.execute_query(
-                "SELECT MAX(module_number) as max_num FROM modules WHERE group_id = ?",
-                (student_group['id'],)
-            )[0]
+            # Ranking of the latest module, shared by the whole group (cached)
+            rows = await StudentHandlers._get_leaderboard(student_group['id'])
 
-            if not latest_module['max_num']:
+            if not rows:
                 await update.message.reply_text("📊 Hali hech qanday modul yaratilmagan.")
                 return
 
-            current_module_num = latest_module['max_num']
-
-            # Get leaderboard for current module
-            leaderboard = db.execute_query(
-                """SELECT s.fullname, g.score, g.graded_at
-                   FROM grades g
-                   JOIN students s ON g.student_id = s.id
-                   JOIN modules m ON g.module_id = m.id
-                   WHERE m.group_id = ? AND m.module_number = ?
-                   ORDER BY g.score DESC, g.graded_at ASC""",
-                (student_group['id'], current_module_num)
-            )
+            current_module_num = rows[0]['module_number']
 
-            if not leaderboard:
+            if rows[0]['position'] is None:
                 await update.message.reply_text(
                     f"📊 Reytinglar jadval\n"
                     f"📖 Modul #{current_module_num}\n\n"
@@ -421,125 +458,200 @@ class StudentHandlers:
                 )
                 return
 
-            # Build leaderboard message
-            message = (
-                f"🏆 Guruh reytinglari\n"
-                f"📚 Guruh: {student_group['name']}\n"
-                f"📖 Modul: #{current_module_num}\n\n"
-            )
+            # Build leaderboard message from parts, joined once at the end
+            parts = [_LEADERBOARD_HEADER_TEMPLATE.format(
+                group=student_group['name'],
+                module_number=current_module_num
+            )]
 
-            # Find current student's position
-            current_student_position = None
-            for i, entry in enumerate(leaderboard, 1):
-                if entry['fullname'] == student['fullname']:
-                    current_student_position = i
-                    break
+            # Current student's position comes straight from the ranked rows
+            own_entry = next((entry for entry in rows if entry['student_id'] == student['id']), None)
+            current_student_position = own_entry['position'] if own_entry else None
 
             # Show top performers and current student
-            for i, entry in enumerate(leaderboard[:10], 1):  # Top 10
-                position_emoji = StudentHandlers._get_position_emoji(i)
+            for entry in rows[:10]:  # Top 10
+                position_emoji = StudentHandlers._get_position_emoji(entry['position'])
                 grade_emoji = StudentHandlers._get_grade_emoji(entry['score'])
 
                 # Highlight current student
-                if entry['fullname'] == student['fullname']:
-                    message += f"➤ {position_emoji} {entry['fullname']}: {entry['score']}/100 {grade_emoji} (Siz)\n"
+                if entry['student_id'] == student['id']:
+                    parts.append(f"➤ {position_emoji} {entry['fullname']}: {entry['score']}/100 {grade_emoji} (Siz)\n")
                 else:
-                    message += f"{position_emoji} {entry['fullname']}: {entry['score']}/100 {grade_emoji}\n"
+                    parts.append(f"{position_emoji} {entry['fullname']}: {entry['score']}/100 {grade_emoji}\n")
 
             # If current student is not in top 10, show their position
             if current_student_position and current_student_position > 10:
-                message += f"\n...\n➤ {current_student_position}. {student['fullname']}: {leaderboard[current_student_position - 1]['score']}/100 (Siz)\n"
+                parts.append(f"\n...\n➤ {current_student_position}. {student['fullname']}: {own_entry['score']}/100 (Siz)\n")
 
             # Add motivational message
             if current_student_position == 1:
-                message += "\n🎉 Tabriklaymiz! Siz birinchi o'rindasiz!"
+                parts.append("\n🎉 Tabriklaymiz! Siz birinchi o'rindasiz!")
             elif current_student_position and current_student_position <= 3:
-                message += "\n💪 Ajoyib! Siz eng yaxshilar qatorida!"
+                parts.append("\n💪 Ajoyib! Siz eng yaxshilar qatorida!")
             else:
-                message += "\n📈 Davom eting! Har doim yaxshilanish mumkin!"
+                parts.append("\n📈 Davom eting! Har doim yaxshilanish mumkin!")
 
+            message = "".join(parts)
             await update.message.reply_text(message)
 
-        except Exception as e:
-            print(f"Error showing leaderboard: {e}")
+        except Exception:
+            logger.exception("Error showing leaderboard")
             await update.message.reply_text(config.MESSAGES['something_wrong'])
 
     # Helper methods for student operations
     @staticmethod
-    def _get_active_task(group_id):
-        """Get the currently active task for a group"""
+    async def _student(context):
+        """Student record of the logged-in user, looked up once and kept in user_data"""
+        student = context.user_data.get('student')
+        if student is None:
+            student = await asyncio.to_thread(auth._get_student_by_phone, context.user_data.get('user_phone'))
+            if student:
+                context.user_data['student'] = student
+        return student
+
+    @staticmethod
+    async def _group(context):
+        """Learning group of the logged-in student, looked up once and kept in user_data"""
+        group = context.user_data.get('group')
+        if group is None:
+            student = await StudentHandlers._student(context)
+            group = await asyncio.to_thread(auth._get_group_by_id, student['group_id']) if student else None
+            if group:
+                context.user_data['group'] = group
+        return group
+
+    @staticmethod
+    async def _get_active_task(group_id):
+        """Get the currently active task for a group (cached for ACTIVE_TASK_CACHE_TTL seconds)"""
+        cached = StudentHandlers._active_task_cache.get(group_id)
+        if cached and time.monotonic() - cached[0] < ACTIVE_TASK_CACHE_TTL:
+            return cached[1]
+
         try:
-            tasks = db.execute_query(
+            tasks = await db.execute_query_async(
                 """SELECT t.* FROM tasks t
                    JOIN modules m ON t.module_id = m.id
                    WHERE m.group_id = ? AND t.is_active = TRUE
                    ORDER BY t.created_at DESC LIMIT 1""",
                 (group_id,)
             )
-            return tasks[0] if tasks else None
+            task = tasks[0] if tasks else None
+            StudentHandlers._active_task_cache[group_id] = (time.monotonic(), task)
+            return task
         except:
             return None
 
     @staticmethod
-    def _get_student_submission(task_id, student_id):
-        """Check if student has submitted for a specific task"""
+    def invalidate_active_task(group_id):
+        """Forget the cached active task of a group; called when a teacher publishes a new one"""
+        StudentHandlers._active_task_cache.pop(group_id, None)
+
+    @staticmethod
+    async def _get_leaderboard(group_id):
+        """
+        Ranked grades of the group's latest module, cached for LEADERBOARD_CACHE_TTL seconds.
+        The ranking is the same for every student of the group, so one query serves them all.
+        A group with modules but no grades yields a single row with NULL ranking columns.
+        """
+        cached = StudentHandlers._leaderboard_cache.get(group_id)
+        if cached and time.monotonic() - cached[0] < LEADERBOARD_CACHE_TTL:
+            return cached[1]
+
+        rows = await db.execute_query_async(
+            """WITH latest AS (
+                   SELECT id, module_number FROM modules
+                   WHERE group_id = ?
+                   ORDER BY module_number DESC LIMIT 1
+               ),
+               ranked AS (
+                   SELECT g.student_id, s.fullname, g.score,
+                          ROW_NUMBER() OVER (ORDER BY g.score DESC, g.graded_at ASC) AS position
+                   FROM grades g
+                   JOIN students s ON g.student_id = s.id
+                   JOIN latest ON g.module_id = latest.id
+               )
+               SELECT latest.module_number, r.student_id, r.fullname, r.score, r.position
+               FROM latest
+               LEFT JOIN ranked r ON TRUE
+               ORDER BY r.position""",
+            (group_id,)
+        )
+        StudentHandlers._leaderboard_cache[group_id] = (time.monotonic(), rows)
+        return rows
+
+    @staticmethod
+    def invalidate_leaderboard(group_id):
+        """Forget the cached ranking of a group; called when a grade or module is added"""
+        StudentHandlers._leaderboard_cache.pop(group_id, None)
+
+    @staticmethod
+    async def _get_task_context(group_id, student_id):
+        """
+        Get the group's active task together with the student's submission and grade.
+        Submission and grade columns are NULL when the student hasn't submitted / been graded.
+        """
         try:
-            submissions = db.execute_query(
-                "SELECT * FROM submissions WHERE task_id = ? AND student_id = ?",
-                (task_id, student_id)
+            rows = await db.execute_query_async(
+                """SELECT t.id, t.module_id, t.description, t.photos, t.created_at,
+                          m.module_number,
+                          s.id AS submission_id, s.submitted_at, s.is_graded,
+                          g.score, g.graded_at
+                   FROM tasks t
+                   JOIN modules m ON t.module_id = m.id
+                   LEFT JOIN submissions s ON s.task_id = t.id AND s.student_id = ?
+                   LEFT JOIN grades g ON g.submission_id = s.id
+                   WHERE m.group_id = ? AND t.is_active = TRUE
+                   ORDER BY t.created_at DESC LIMIT 1""",
+                (student_id, group_id)
             )
-            return submissions[0] if submissions else None
+            return rows[0] if rows else None
         except:
             return None
 
     @staticmethod
-    def _get_submission_grade(submission_id):
-        """Get grade for a specific submission"""
+    async def _get_student_submission(task_id, student_id):
+        """Check if student has submitted for a specific task"""
         try:
-            grades = db.execute_query(
-                "SELECT * FROM grades WHERE submission_id = ?",
-                (submission_id,)
+            submissions = await db.execute_query_async(
+                "SELECT * FROM submissions WHERE task_id = ? AND student_id = ?",
+                (task_id, student_id)
             )
-            return grades[0] if grades else None
+            return submissions[0] if submissions else None
         except:
             return None
 
     @staticmethod
-    def _get_queue_position(student_id, group_id):
+    async def _get_queue_position(student_id, group_id):
         """Calculate student's position in grading queue"""
         try:
-            # Get all ungraded submissions for this group, ordered by submission time
-            ungraded = db.execute_query(
-                """SELECT s.student_id FROM submissions s
-                   JOIN tasks t ON s.task_id = t.id
-                   JOIN modules m ON t.module_id = m.id
-                   WHERE m.group_id = ? AND s.is_graded = FALSE
-                   ORDER BY s.submitted_at ASC""",
-                (group_id,)
+            # Number the group's ungraded submissions by submission time and pick the student's
+            result = await db.execute_query_async(
+                """WITH queue AS (
+                       SELECT s.student_id,
+                              ROW_NUMBER() OVER (ORDER BY s.submitted_at ASC, s.id ASC) AS position
+                       FROM submissions s
+                       JOIN tasks t ON s.task_id = t.id
+                       JOIN modules m ON t.module_id = m.id
+                       WHERE m.group_id = ? AND s.is_graded = FALSE
+                   )
+                   SELECT MIN(position) AS position FROM queue WHERE student_id = ?""",
+                (group_id, student_id)
             )
-
-            for i, submission in enumerate(ungraded, 1):
-                if submission['student_id'] == student_id:
-                    return i
-            return 0
+            return result[0]['position'] or 0
         except:
             return 0
 
     @staticmethod
-    def _get_latest_grade(student_phone):
+    async def _get_latest_grade(student_id):
         """Get student's most recent grade with module info"""
         try:
-            student = auth._get_student_by_phone(student_phone)
-            if not student:
-                return None
-
-            grades = db.execute_query(
+            grades = await db.execute_query_async(
                 """SELECT g.score, m.module_number
                    FROM grades g
                    JOIN modules m ON g.module_id = m.id
                    WHERE g.student_id = ?
                    ORDER BY g.graded_at DESC LIMIT 1""",
-                (student['id'],)
+                (student_id,)
             )
             return grades[0] if grades else None
         except:
@@ -548,28 +660,12 @@ class StudentHandlers:
     @staticmethod
     def _get_grade_emoji(score):
         """Get appropriate emoji for grade score"""
-        if score >= 90:
-            return "🌟"
-        elif score >= 80:
-            return "⭐"
-        elif score >= 70:
-            return "✅"
-        elif score >= 60:
-            return "👍"
-        else:
-            return "📈"
+        return _GRADE_EMOJI[max(0, min(score, 100))]
 
     @staticmethod
     def _get_position_emoji(position):
         """Get emoji for leaderboard position"""
-        if position == 1:
-            return "🥇"
-        elif position == 2:
-            return "🥈"
-        elif position == 3:
-            return "🥉"
-        else:
-            return f"{position}."
+        return _POSITION_EMOJI.get(position) or f"{position}."
 
     @staticmethod
     async def cancel_operation(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -583,12 +679,8 @@ class StudentHandlers:
 
     @staticmethod
     def _get_cancel_keyboard():
-        """Helper method to create a cancel-only keyboard"""
-        return ReplyKeyboardMarkup(
-            [[KeyboardButton(config.BUTTONS['cancel'])]],
-            resize_keyboard=True,
-            one_time_keyboard=True
-        )
+        """Helper method returning the shared cancel-only keyboard"""
+        return _CANCEL_MARKUP
 
 
 # Create global instance for easy import
@@ -1,14 +1,90 @@
+import asyncio
+import functools
+import logging
+import time
+
 from telegram import Update, ReplyKeyboardMarkup, KeyboardButton
-from telegram.ext import ContextTypes, ConversationHandler
+from telegram.ext import ContextTypes, ConversationHandler, filters
 from database import db
-from config import config
+from config import config, format_phone, photos_to_json, json_to_photos
 from auth import auth
-import json
+from handlers.student_handlers import student_handlers
+from media import album_count, send_photos, truncate
+from rate_limiter import outbound_queue, rate_limited
+
+logger = logging.getLogger(__name__)
 
 # Conversation states for teacher operations - each represents a different input stage
 WAITING_GROUP_NAME, WAITING_CHANNEL_ID, WAITING_STUDENT_NAME, WAITING_STUDENT_PHONE = range(4)
 WAITING_TASK_DESCRIPTION, WAITING_TASK_PHOTOS, WAITING_GRADE = range(4, 7)
 
+# Longest caption Telegram accepts on a photo
+TELEGRAM_CAPTION_LIMIT = 1024
+
+# How long (seconds) a teacher's group list and a group's current module are reused;
+# both only change through this module, which drops the cached entry right away
+TEACHER_DATA_CACHE_TTL = 600
+
+# Button texts, bound once for the per-message comparisons
+_CANCEL = config.BUTTONS['cancel']
+_DONE = config.BUTTONS['done']
+_BACK = config.BUTTONS['back']
+
+# Grading keyboard texts: part of the "next submission" label and the pause button
+_NEXT_SUBMISSION_MARKER = "Keyingi ish"
+_PAUSE_GRADING_TEXT = "⏸ Keyinroq baholash"
+
+# What the grading state accepts: a number, the "next submission" button or the pause button.
+# Anything else falls through to the regular menu handlers.
+GRADE_INPUT_FILTER = (
+    filters.Regex(r'^\d+$')
+    | filters.Regex(_NEXT_SUBMISSION_MARKER)
+    | filters.Text([_PAUSE_GRADING_TEXT])
+)
+
+# Keyboards that never change, built once
+_TEACHER_MENU_MARKUP = ReplyKeyboardMarkup(
+    [
+        [KeyboardButton(config.BUTTONS['my_groups'])],
+        [KeyboardButton(config.BUTTONS['create_group'])],
+    ],
+    resize_keyboard=True,
+    one_time_keyboard=False
+)
+
+_GROUP_MENU_MARKUP = ReplyKeyboardMarkup(
+    [
+        [KeyboardButton(config.BUTTONS['create_module'])],
+        [KeyboardButton(config.BUTTONS['create_task'])],
+        [KeyboardButton(config.BUTTONS['grade_submissions'])],
+        [KeyboardButton(config.BUTTONS['add_student'])],
+        [KeyboardButton(config.BUTTONS['remove_student'])],
+        [KeyboardButton(config.BUTTONS['back_to_groups'])]
+    ],
+    resize_keyboard=True,
+    one_time_keyboard=False
+)
+
+_DONE_OR_CANCEL_MARKUP = ReplyKeyboardMarkup(
+    [[KeyboardButton(config.BUTTONS['done'])],
+     [KeyboardButton(config.BUTTONS['cancel'])]],
+    resize_keyboard=True,
+    one_time_keyboard=True
+)
+
+_CANCEL_MARKUP = ReplyKeyboardMarkup(
+    [[KeyboardButton(config.BUTTONS['cancel'])]],
+    resize_keyboard=True,
+    one_time_keyboard=True
+)
+
+# Grading keyboard for the last submission in the queue (no "next" button)
+_LAST_SUBMISSION_MARKUP = ReplyKeyboardMarkup(
+    [[KeyboardButton(_PAUSE_GRADING_TEXT)]],
+    resize_keyboard=True,
+    one_time_keyboard=True
+)
+
 
 class TeacherHandlers:
     """
@@ -23,33 +99,36 @@ class TeacherHandlers:
     4. Provide timely feedback through grading
     """
 
+    # teacher phone -> (monotonic timestamp, list of group rows)
+    _teacher_groups_cache = {}
+
+    # group_id -> (monotonic timestamp, latest module row or None)
+    _current_module_cache = {}
+
+    @staticmethod
+    async def get_session(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """The user's session row; AuthSystem caches it, so repeated reads are dict lookups"""
+        return await auth.get_user_session_async(update.effective_user.id)
+
     @staticmethod
     async def show_teacher_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
         """
         Display the main teacher control panel.
         This is where teachers choose their primary educational activities.
         """
-        # Clear any existing session when returning to main menu
-        auth.clear_user_session(update.effective_user.id)
-
-        keyboard = [
-            [KeyboardButton(config.BUTTONS['my_groups'])],
-            [KeyboardButton(config.BUTTONS['create_group'])],
-        ]
-
-        reply_markup = ReplyKeyboardMarkup(
-            keyboard,
-            resize_keyboard=True,
-            one_time_keyboard=False
-        )
+        # Clear any existing session (and any grading in progress) when returning to main menu
+        await asyncio.to_thread(auth.clear_user_session, update.effective_user.id)
+        context.user_data.pop('selected_group_id', None)
+        TeacherHandlers._drop_grading_data(context)
 
         await update.message.reply_text(
             "👨‍🏫 O'qituvchi Paneli\n\n"
             "Ta'lim jarayonini boshqarish uchun quyidagi tanlovlardan birini bajaring:",
-            reply_markup=reply_markup
+            reply_markup=_TEACHER_MENU_MARKUP
         )
 
     @staticmethod
+    @rate_limited()
     async def show_my_groups(update: Update, context: ContextTypes.DEFAULT_TYPE):
         """
         Display all groups belonging to this teacher.
@@ -64,7 +143,7 @@ class TeacherHandlers:
                 return
 
             # Retrieve all groups created by this teacher
-            groups = auth.get_teacher_groups(teacher_phone)
+            groups = await TeacherHandlers._get_teacher_groups(teacher_phone)
 
             if not groups:
                 await update.message.reply_text(
@@ -73,16 +152,12 @@ class TeacherHandlers:
                 )
                 return
 
-            # Create interactive buttons for each group
-            keyboard = []
-            for group in groups:
-                # Show group name with student count for quick overview
-                student_count = TeacherHandlers._get_group_student_count(group['id'])
-                button_text = f"📚 {group['name']} ({student_count} talaba)"
-                keyboard.append([KeyboardButton(button_text)])
+            # Create interactive buttons for each group, remembering which group each button selects
+            group_button_map = TeacherHandlers._build_group_button_map(groups)
+            keyboard = [[KeyboardButton(button_text)] for button_text in group_button_map]
 
             # Add navigation button
-            keyboard.append([KeyboardButton(config.BUTTONS['back'])])
+            keyboard.append([KeyboardButton(_BACK)])
 
             reply_markup = ReplyKeyboardMarkup(
                 keyboard,
@@ -90,8 +165,8 @@ class TeacherHandlers:
                 one_time_keyboard=True
             )
 
-            # Store groups data for when user selects one
-            context.user_data['teacher_groups'] = groups
+            # Store groups by button text for when user selects one
+            context.user_data['group_button_map'] = group_button_map
 
             await update.message.reply_text(
                 "📚 Sizning guruhlaringiz:\n\n"
@@ -99,11 +174,12 @@ class TeacherHandlers:
                 reply_markup=reply_markup
             )
 
-        except Exception as e:
-            print(f"Error showing teacher groups: {e}")
+        except Exception:
+            logger.exception("Error showing teacher groups")
             await update.message.reply_text(config.MESSAGES['something_wrong'])
 
     @staticmethod
+    @rate_limited()
     async def select_group(update: Update, context: ContextTypes.DEFAULT_TYPE):
         """
         Handle group selection and show group management options.
@@ -112,36 +188,51 @@ class TeacherHandlers:
         """
         selected_text = update.message.text.strip()
 
-        if selected_text == config.BUTTONS['back']:
+        if selected_text == _BACK:
             await TeacherHandlers.show_teacher_menu(update, context)
             return
 
         try:
-            # Find the selected group by matching the button text format
-            groups = context.user_data.get('teacher_groups', [])
-            selected_group = None
+            # Find the selected group by the button it was shown on
+            selected_group = context.user_data.get('group_button_map', {}).get(selected_text)
+
+            if not selected_group:
+                # user_data was reset since the keyboard was shown: rebuild the map from the
+                # cached group list so the following presses are plain lookups again
+                groups = await TeacherHandlers._get_teacher_groups(context.user_data.get('user_phone'))
+                group_button_map = TeacherHandlers._build_group_button_map(groups)
+                context.user_data['group_button_map'] = group_button_map
+                selected_group = group_button_map.get(selected_text)
 
-            for group in groups:
-                student_count = TeacherHandlers._get_group_student_count(group['id'])
-                button_text = f"📚 {group['name']} ({student_count} talaba)"
-                if button_text == selected_text:
-                    selected_group = group
-                    break
+            if not selected_group:
+                # Button from an older keyboard (student count changed):
+                # match on the group name between "📚 " and the " (N talaba)" suffix
+                group_name = selected_text.removeprefix("📚").rsplit(" (", 1)[0].strip()
+                selected_group = next(
+                    (group for group in group_button_map.values() if group['name'] == group_name), None
+                )
 
             if not selected_group:
                 await update.message.reply_text("❌ Noto'g'ri tanlov. Qaytadan urinib ko'ring.")
                 return
 
             # Set user session to track which group they're working with
-            auth.set_user_session(update.effective_user.id, selected_group['id'])
+            await asyncio.to_thread(auth.set_user_session, update.effective_user.id, selected_group['id'])
+            # Kept alongside the session so the back button needs no session lookup
+            context.user_data['selected_group_id'] = selected_group['id']
 
             # Show group management menu
             await TeacherHandlers.show_group_management_menu(update, context, selected_group)
 
-        except Exception as e:
-            print(f"Error selecting group: {e}")
+        except Exception:
+            logger.exception("Error selecting group")
             await update.message.reply_text(config.MESSAGES['something_wrong'])
 
+    @staticmethod
+    def _build_group_button_map(groups):
+        """Map each group's button text (name with student count) to its group row"""
+        return {f"📚 {group['name']} ({group['student_count']} talaba)": group for group in groups}
+
     @staticmethod
     async def show_group_management_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, group):
         """
@@ -149,38 +240,22 @@ class TeacherHandlers:
         This menu represents the core educational activities teachers perform.
         """
         # Get current module info for context
-        current_module = TeacherHandlers._get_current_module(group['id'])
-
-        keyboard = [
-            [KeyboardButton(config.BUTTONS['create_module'])],
-            [KeyboardButton(config.BUTTONS['create_task'])],
-            [KeyboardButton(config.BUTTONS['grade_submissions'])],
-            [KeyboardButton(config.BUTTONS['add_student'])],
-            [KeyboardButton(config.BUTTONS['remove_student'])],
-            [KeyboardButton(config.BUTTONS['back_to_groups'])]
-        ]
-
-        reply_markup = ReplyKeyboardMarkup(
-            keyboard,
-            resize_keyboard=True,
-            one_time_keyboard=False
-        )
+        current_module = await TeacherHandlers._get_current_module(group['id'])
 
         # Show group status with educational context
         module_info = ""
         if current_module:
             module_info = f"\n📖 Joriy modul: #{current_module['module_number']}"
 
-        student_count = TeacherHandlers._get_group_student_count(group['id'])
-
         await update.message.reply_text(
             f"📚 Guruh: {group['name']}\n"
-            f"👥 Talabalar soni: {student_count}{module_info}\n\n"
+            f"👥 Talabalar soni: {group['student_count']}{module_info}\n\n"
             "Quyidagi amallardan birini tanlang:",
-            reply_markup=reply_markup
+            reply_markup=_GROUP_MENU_MARKUP
         )
 
     @staticmethod
+    @rate_limited()
     async def create_new_module(update: Update, context: ContextTypes.DEFAULT_TYPE):
         """
         Create a new learning module for the selected group.
@@ -189,7 +264,7 @@ class TeacherHandlers:
         """
         try:
             # Get current session to know which group we're working with
-            session = auth.get_user_session(update.effective_user.id)
+            session = await TeacherHandlers.get_session(update, context)
             if not session:
                 await update.message.reply_text("❌ Guruh tanlanmagan. Qaytadan boshlang.")
                 return
@@ -197,7 +272,7 @@ class TeacherHandlers:
             group_id = session['selected_group_id']
 
             # Calculate next module number (auto-increment within group)
-            last_module = db.execute_query(
+            last_module = await db.execute_query_async(
                 "SELECT MAX(module_number) as max_num FROM modules WHERE group_id = ?",
                 (group_id,)
             )
@@ -207,10 +282,12 @@ class TeacherHandlers:
                 next_module_number = last_module[0]['max_num'] + 1
 
             # Create the new module
-            module_id = db.execute_query(
+            module_id = await db.execute_query_async(
                 "INSERT INTO modules (group_id, module_number) VALUES (?, ?)",
                 (group_id, next_module_number)
             )
+            TeacherHandlers._current_module_cache.pop(group_id, None)
+            student_handlers.invalidate_leaderboard(group_id)
 
             await update.message.reply_text(
                 f"✅ Yangi modul yaratildi!\n\n"
@@ -219,11 +296,12 @@ class TeacherHandlers:
                 "Endi bu modul uchun vazifalar yaratishingiz mumkin."
             )
 
-        except Exception as e:
-            print(f"Error creating module: {e}")
+        except Exception:
+            logger.exception("Error creating module")
             await update.message.reply_text(config.MESSAGES['something_wrong'])
 
     @staticmethod
+    @rate_limited()
     async def start_create_task(update: Update, context: ContextTypes.DEFAULT_TYPE):
         """
         Begin task creation process.
@@ -231,13 +309,13 @@ class TeacherHandlers:
         Each task belongs to a module and represents specific learning objectives.
         """
         try:
-            session = auth.get_user_session(update.effective_user.id)
+            session = await TeacherHandlers.get_session(update, context)
             if not session:
                 await update.message.reply_text("❌ Guruh tanlanmagan.")
                 return
 
             # Check if we have a current module
-            current_module = TeacherHandlers._get_current_module(session['selected_group_id'])
+            current_module = await TeacherHandlers._get_current_module(session['selected_group_id'])
             if not current_module:
                 await update.message.reply_text(
                     "❌ Avval modul yaratish kerak!\n"
@@ -249,13 +327,13 @@ class TeacherHandlers:
                 f"📋 Vazifa yaratish\n"
                 f"📖 Modul: #{current_module['module_number']}\n\n"
                 f"{config.MESSAGES['enter_task_description']}",
-                reply_markup=TeacherHandlers._get_cancel_keyboard()
+                reply_markup=_CANCEL_MARKUP
             )
 
             return WAITING_TASK_DESCRIPTION
 
-        except Exception as e:
-            print(f"Error starting task creation: {e}")
+        except Exception:
+            logger.exception("Error starting task creation")
             await update.message.reply_text(config.MESSAGES['something_wrong'])
             return ConversationHandler.END
 
@@ -267,22 +345,20 @@ class TeacherHandlers:
         """
         description = update.message.text.strip()
 
-        if description == config.BUTTONS['cancel']:
+        if description == _CANCEL:
             await TeacherHandlers.cancel_operation(update, context)
             return ConversationHandler.END
 
         # Store description for later use
         context.user_data['task_description'] = description
+        # Photos sent in the next step are collected here until 'Tayyor'
+        context.user_data['task_photos'] = []
 
         # Ask for photos (optional)
         await update.message.reply_text(
             f"{config.MESSAGES['send_task_photos']}\n\n"
             "Rasm yubormasangiz, 'Tayyor' tugmasini bosing.",
-            reply_markup=ReplyKeyboardMarkup(
-                [[KeyboardButton(config.BUTTONS['done'])],
-                 [KeyboardButton(config.BUTTONS['cancel'])]],
-                resize_keyboard=True, one_time_keyboard=True
-            )
+            reply_markup=_DONE_OR_CANCEL_MARKUP
         )
 
         return WAITING_TASK_PHOTOS
@@ -294,18 +370,14 @@ class TeacherHandlers:
         Photos help provide visual context and clarity for task instructions.
         """
         try:
-            session = auth.get_user_session(update.effective_user.id)
-            current_module = TeacherHandlers._get_current_module(session['selected_group_id'])
-
-            task_description = context.user_data.get('task_description')
-            photos = []
+            photos = context.user_data.setdefault('task_photos', [])
 
             # Handle different message types
             if update.message.text:
-                if update.message.text == config.BUTTONS['cancel']:
+                if update.message.text == _CANCEL:
                     await TeacherHandlers.cancel_operation(update, context)
                     return ConversationHandler.END
-                elif update.message.text != config.BUTTONS['done']:
+                elif update.message.text != _DONE:
                     await update.message.reply_text("Faqat rasm yuboring yoki 'Tayyor' tugmasini bosing.")
                     return WAITING_TASK_PHOTOS
             elif update.message.photo:
@@ -318,39 +390,47 @@ class TeacherHandlers:
                 )
                 return WAITING_TASK_PHOTOS
 
-            # Deactivate any existing active tasks for this group (only one active task per group)
-            db.execute_query(
-                """UPDATE tasks SET is_active = FALSE 
-                   WHERE module_id IN (SELECT id FROM modules WHERE group_id = ?)""",
-                (session['selected_group_id'],)
-            )
-
-            # Create the new task
-            task_id = db.execute_query(
-                "INSERT INTO tasks (module_id, description, photos, is_active) VALUES (?, ?, ?, ?)",
-                (current_module['id'], task_description, config.photos_to_json(photos), True)
-            )
-
-            # Send notification to group channel
-            await TeacherHandlers._notify_group_channel(update, context, session['selected_group_id'], task_description,
-                                                        photos)
+            session = await TeacherHandlers.get_session(update, context)
+            current_module = await TeacherHandlers._get_current_module(session['selected_group_id'])
+            task_description = context.user_data.get('task_description')
 
-            await update.message.reply_text(
-                f"✅ Vazifa muvaffaqiyatli yaratildi va guruhlarga yuborildi!\n\n"
-                f"📋 Vazifa: {task_description[:100]}{'...' if len(task_description) > 100 else ''}\n"
-                f"📖 Modul: #{current_module['module_number']}\n"
-                f"🆔 Vazifa ID: {task_id}"
+            # Deactivate any existing active tasks for this group (only one active task per group)
+            # and create the new task, in one transaction
+            task_id = await db.execute_transaction_async([
+                ("""UPDATE tasks SET is_active = FALSE 
+                    WHERE module_id IN (SELECT id FROM modules WHERE group_id = ?)""",
+                 (session['selected_group_id'],)),
+                ("INSERT INTO tasks (module_id, description, photos, is_active) VALUES (?, ?, ?, ?)",
+                 (current_module['id'], task_description, photos_to_json(photos), True)),
+            ])
+            student_handlers.invalidate_active_task(session['selected_group_id'])
+
+            # Channel notification and teacher confirmation are independent, so send them together
+            results = await asyncio.gather(
+                TeacherHandlers._notify_group_channel(update, context, session['selected_group_id'],
+                                                      task_description, photos),
+                update.message.reply_text(
+                    f"✅ Vazifa muvaffaqiyatli yaratildi va guruhlarga yuborildi!\n\n"
+                    f"📋 Vazifa: {truncate(task_description)}\n"
+                    f"📖 Modul: #{current_module['module_number']}\n"
+                    f"🆔 Vazifa ID: {task_id}"
+                ),
+                return_exceptions=True
             )
+            for result in results:
+                if isinstance(result, Exception):
+                    logger.error("Error sending task notification", exc_info=result)
 
-            context.user_data.clear()
+            TeacherHandlers._drop_flow_data(context)
             return ConversationHandler.END
 
-        except Exception as e:
-            print(f"Error creating task: {e}")
+        except Exception:
+            logger.exception("Error creating task")
             await update.message.reply_text(config.MESSAGES['something_wrong'])
             return ConversationHandler.END
 
     @staticmethod
+    @rate_limited()
     async def start_grading(update: Update, context: ContextTypes.DEFAULT_TYPE):
         """
         Begin the grading workflow.
@@ -358,57 +438,79 @@ class TeacherHandlers:
         and assessment to guide student learning and progress.
         """
         try:
-            session = auth.get_user_session(update.effective_user.id)
+            session = await TeacherHandlers.get_session(update, context)
             if not session:
                 await update.message.reply_text("❌ Guruh tanlanmagan.")
-                return
+                return ConversationHandler.END
 
             # Get ungraded submissions for this group
-            ungraded_submissions = TeacherHandlers._get_ungraded_submissions(session['selected_group_id'])
+            ungraded_submissions = await TeacherHandlers._get_ungraded_submissions(session['selected_group_id'])
 
             if not ungraded_submissions:
                 await update.message.reply_text(
                     "✅ Barcha ishlar baholangan yoki hali hech kim ish topshirmagan.\n"
                     "Yangi topshiriqlar kelganda xabar beramiz."
                 )
-                return
+                return ConversationHandler.END
 
             # Set grading session
-            auth.set_user_session(update.effective_user.id, session['selected_group_id'], 'grading')
+            await asyncio.to_thread(
+                auth.set_user_session, update.effective_user.id, session['selected_group_id'], 'grading'
+            )
 
             # Show first submission
-            await TeacherHandlers._show_next_submission(update, context, ungraded_submissions)
+            return await TeacherHandlers._show_next_submission(update, context, ungraded_submissions)
 
-        except Exception as e:
-            print(f"Error starting grading: {e}")
+        except Exception:
+            logger.exception("Error starting grading")
             await update.message.reply_text(config.MESSAGES['something_wrong'])
+            return ConversationHandler.END
+
+    @staticmethod
+    def _drop_grading_data(context: ContextTypes.DEFAULT_TYPE):
+        """Forget the grading queue kept in user_data"""
+        context.user_data.pop('current_submission', None)
+        context.user_data.pop('remaining_submissions', None)
+
+    @staticmethod
+    def _drop_flow_data(context: ContextTypes.DEFAULT_TYPE):
+        """
+        Forget what the task, group and student flows collected. Auth keys and the
+        selected group stay, so the teacher is not logged out by finishing a flow.
+        """
+        context.user_data.pop('task_description', None)
+        context.user_data.pop('task_photos', None)
+        context.user_data.pop('group_name', None)
+        context.user_data.pop('student_name', None)
+
+    @staticmethod
+    async def leave_grading(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """
+        End a grading session the teacher walked away from (e.g. with the back button):
+        the group stays selected, but later digits are no longer taken as grades.
+        """
+        session = await TeacherHandlers.get_session(update, context)
+        if session and session['session_type'] == 'grading':
+            await asyncio.to_thread(auth.set_user_session, update.effective_user.id, session['selected_group_id'])
+            TeacherHandlers._drop_grading_data(context)
 
     @staticmethod
     async def _show_next_submission(update: Update, context: ContextTypes.DEFAULT_TYPE, submissions_queue):
         """
         Display the next submission in the grading queue.
         This creates an efficient workflow for teachers to review student work systematically.
+        Returns the next conversation state: WAITING_GRADE, or END once the queue is empty.
         """
         if not submissions_queue:
             await update.message.reply_text("✅ Barcha ishlar baholandi!")
-            auth.clear_user_session(update.effective_user.id)
+            await asyncio.to_thread(auth.clear_user_session, update.effective_user.id)
+            context.user_data.pop('selected_group_id', None)
             await TeacherHandlers.show_teacher_menu(update, context)
-            return
+            return ConversationHandler.END
 
         current_submission = submissions_queue[0]
         remaining_count = len(submissions_queue) - 1
 
-        # Get student and task info for context
-        student_info = db.execute_query(
-            "SELECT fullname FROM students WHERE id = ?",
-            (current_submission['student_id'],)
-        )[0]
-
-        task_info = db.execute_query(
-            "SELECT description FROM tasks WHERE id = ?",
-            (current_submission['task_id'],)
-        )[0]
-
         # Store current submission data
         context.user_data['current_submission'] = current_submission
         context.user_data['remaining_submissions'] = submissions_queue[1:]
@@ -416,8 +518,8 @@ class TeacherHandlers:
         # Format submission message
         message = (
             f"📝 Baholash navbati\n\n"
-            f"👤 Talaba: {student_info['fullname']}\n"
-            f"📋 Vazifa: {task_info['description'][:100]}{'...' if len(task_info['description']) > 100 else ''}\n"
+            f"👤 Talaba: {current_submission['student_name']}\n"
+            f"📋 Vazifa: {truncate(current_submission['task_description'])}\n"
             f"📅 Topshirilgan: {current_submission['submitted_at'][:16]}\n\n"
         )
 
@@ -428,96 +530,114 @@ class TeacherHandlers:
         message += "Bahoni 0-100 orasida kiriting:"
 
         # Send submission photos if available
-        photos = config.json_to_photos(current_submission['photos'])
-        if photos:
-            for photo_id in photos:
-                await update.message.bot.send_photo(
-                    chat_id=update.effective_chat.id,
-                    photo=photo_id
-                )
+        await send_photos(
+            update.message.bot, update.effective_chat.id, json_to_photos(current_submission['photos'])
+        )
 
         await update.message.reply_text(
             message,
             reply_markup=TeacherHandlers._get_grading_keyboard(remaining_count)
         )
+        return WAITING_GRADE
 
     @staticmethod
     async def _get_ungraded_submissions(group_id):
-        """Get all ungraded submissions for a specific group, ordered by submission time"""
-        return db.execute_query(
-            """SELECT s.* FROM submissions s
+        """
+        Get all ungraded submissions for a specific group, ordered by submission time.
+        Each row already carries the student name, task description and module, so the
+        grading loop needs no further lookups.
+        """
+        return await db.execute_query_async(
+            """SELECT s.*, st.fullname AS student_name, t.description AS task_description,
+                      m.id AS module_id, m.module_number, m.group_id
+               FROM submissions s
                JOIN tasks t ON s.task_id = t.id
                JOIN modules m ON t.module_id = m.id
+               JOIN students st ON s.student_id = st.id
                WHERE m.group_id = ? AND s.is_graded = FALSE
                ORDER BY s.submitted_at ASC""",
             (group_id,)
         )
 
     @staticmethod
-    def _get_group_student_count(group_id):
-        """Helper to get the number of students in a group"""
-        try:
-            result = db.execute_query(
-                "SELECT COUNT(*) as count FROM students WHERE group_id = ?",
-                (group_id,)
-            )
-            return result[0]['count'] if result else 0
-        except:
-            return 0
+    async def _get_current_module(group_id):
+        """Get the most recent module for a group (cached for TEACHER_DATA_CACHE_TTL seconds)"""
+        cached = TeacherHandlers._current_module_cache.get(group_id)
+        if cached and time.monotonic() - cached[0] < TEACHER_DATA_CACHE_TTL:
+            return cached[1]
 
-    @staticmethod
-    def _get_current_module(group_id):
-        """Get the most recent module for a group"""
         try:
-            modules = db.execute_query(
+            modules = await db.execute_query_async(
                 "SELECT * FROM modules WHERE group_id = ? ORDER BY module_number DESC LIMIT 1",
                 (group_id,)
             )
-            return modules[0] if modules else None
+            module = modules[0] if modules else None
+            TeacherHandlers._current_module_cache[group_id] = (time.monotonic(), module)
+            return module
         except:
             return None
 
+    @staticmethod
+    async def _get_teacher_groups(teacher_phone):
+        """Get all groups of a teacher (cached for TEACHER_DATA_CACHE_TTL seconds)"""
+        cached = TeacherHandlers._teacher_groups_cache.get(teacher_phone)
+        if cached and time.monotonic() - cached[0] < TEACHER_DATA_CACHE_TTL:
+            return cached[1]
+
+        groups = await asyncio.to_thread(auth.get_teacher_groups, teacher_phone)
+        if groups:
+            TeacherHandlers._teacher_groups_cache[teacher_phone] = (time.monotonic(), groups)
+        return groups
+
+    @staticmethod
+    async def get_teacher_group(teacher_phone, group_id):
+        """One of the teacher's groups (with its student_count), or None if it is not theirs"""
+        for group in await TeacherHandlers._get_teacher_groups(teacher_phone):
+            if group['id'] == group_id:
+                return group
+        return None
+
     @staticmethod
     async def _notify_group_channel(update: Update, context: ContextTypes.DEFAULT_TYPE, group_id, description, photos):
-        """Send task notification to the group's Telegram channel"""
+        """
+        Queue the task notification for the group's Telegram channel.
+        The rate-limited outbound queue sends it in the background, so the teacher isn't kept waiting.
+        """
         try:
-            group = db.execute_query("SELECT * FROM groups WHERE id = ?", (group_id,))[0]
-            channel_id = group['channel_id']
-
+            group = (await db.execute_query_async("SELECT * FROM groups WHERE id = ?", (group_id,)))[0]
             message = f"📋 Yangi vazifa!\n\n{description}"
 
-            # Send photos first if available
-            if photos:
-                for photo_id in photos:
-                    await update.message.bot.send_photo(
-                        chat_id=channel_id,
-                        photo=photo_id
-                    )
+            # One request per album of up to 10, plus one for the text unless it fits as a caption
+            captioned = bool(photos) and len(message) <= TELEGRAM_CAPTION_LIMIT
+            requests = album_count(photos) + (0 if captioned else 1)
+            outbound_queue.enqueue_requests(
+                requests, TeacherHandlers._send_task_notification,
+                update.message.bot, group['channel_id'], message, photos, captioned
+            )
+        except Exception:
+            logger.exception("Error notifying group channel")
 
-            # Send text message
-            await update.message.bot.send_message(
+    @staticmethod
+    async def _send_task_notification(bot, channel_id, message, photos, captioned):
+        """Post a new task (text and photos) to a group channel"""
+        if captioned:
+            # The announcement rides along as the caption of the first photo
+            await send_photos(bot, channel_id, photos, caption=message)
+        else:
+            # Send photos first if available, then the text message
+            await send_photos(bot, channel_id, photos)
+            await bot.send_message(
                 chat_id=channel_id,
                 text=message
             )
-        except Exception as e:
-            print(f"Error notifying group channel: {e}")
 
     @staticmethod
     async def cancel_operation(update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Cancel current operation and return to appropriate menu"""
-        context.user_data.clear()
+        TeacherHandlers._drop_flow_data(context)
         await update.message.reply_text("❌ Amal bekor qilindi.")
         await TeacherHandlers.show_teacher_menu(update, context)
 
-    @staticmethod
-    def _get_cancel_keyboard():
-        """Helper method to create a cancel-only keyboard"""
-        return ReplyKeyboardMarkup(
-            [[KeyboardButton(config.BUTTONS['cancel'])]],
-            resize_keyboard=True,
-            one_time_keyboard=True
-        )
-
     @staticmethod
     async def receive_grade(update: Update, context: ContextTypes.DEFAULT_TYPE):
         """
@@ -525,80 +645,77 @@ class TeacherHandlers:
         This completes the feedback loop in our educational system.
         """
         try:
+            # The conversation can outlive the grading session (menu, back button, restart);
+            # only accept input while the session is still a grading one
+            session = await TeacherHandlers.get_session(update, context)
+            if not session or session['session_type'] != 'grading':
+                TeacherHandlers._drop_grading_data(context)
+                await update.message.reply_text(
+                    f"ℹ️ Baholash yakunlangan. Davom etish uchun "
+                    f"'{config.BUTTONS['grade_submissions']}' tugmasini bosing."
+                )
+                return ConversationHandler.END
+
             grade_text = update.message.text.strip()
 
             # Handle special commands during grading
-            if "Keyingi ish" in grade_text:
+            if _NEXT_SUBMISSION_MARKER in grade_text:
                 remaining_submissions = context.user_data.get('remaining_submissions', [])
-                await TeacherHandlers._show_next_submission(update, context, remaining_submissions)
-                return
-            elif grade_text == "⏸ Keyinroq baholash":
-                auth.clear_user_session(update.effective_user.id)
+                return await TeacherHandlers._show_next_submission(update, context, remaining_submissions)
+            elif grade_text == _PAUSE_GRADING_TEXT:
+                await asyncio.to_thread(auth.clear_user_session, update.effective_user.id)
+                context.user_data.pop('selected_group_id', None)
                 await update.message.reply_text("✅ Baholash to'xtatildi. Keyinroq davom etishingiz mumkin.")
                 await TeacherHandlers.show_teacher_menu(update, context)
-                return
+                return ConversationHandler.END
 
-            # Validate grade input
-            try:
-                grade = int(grade_text)
-                if grade < 0 or grade > 100:
-                    await update.message.reply_text("❌ Baho 0 dan 100 gacha bo'lishi kerak. Qaytadan kiriting:")
-                    return
-            except ValueError:
+            # Validate grade input (plain ASCII digits, so int() below cannot fail)
+            if not (grade_text.isascii() and grade_text.isdigit()):
                 await update.message.reply_text("❌ Faqat raqam kiriting (0-100). Qaytadan urinib ko'ring:")
-                return
+                return WAITING_GRADE
+
+            grade = int(grade_text)
+            if grade > 100:
+                await update.message.reply_text("❌ Baho 0 dan 100 gacha bo'lishi kerak. Qaytadan kiriting:")
+                return WAITING_GRADE
 
             # Get current submission data
             current_submission = context.user_data.get('current_submission')
             if not current_submission:
                 await update.message.reply_text("❌ Xatolik yuz berdi. Qaytadan boshlang.")
-                return
-
-            # Get module info for this submission
-            module_info = db.execute_query(
-                "SELECT m.* FROM modules m JOIN tasks t ON m.id = t.module_id WHERE t.id = ?",
-                (current_submission['task_id'],)
-            )[0]
-
-            # Save the grade
-            db.execute_query(
-                "INSERT INTO grades (submission_id, module_id, student_id, score) VALUES (?, ?, ?, ?)",
-                (current_submission['id'], module_info['id'], current_submission['student_id'], grade)
-            )
-
-            # Mark submission as graded
-            db.execute_query(
-                "UPDATE submissions SET is_graded = TRUE WHERE id = ?",
-                (current_submission['id'],)
-            )
+                return ConversationHandler.END
 
-            # Get student info for confirmation message
-            student_info = db.execute_query(
-                "SELECT fullname FROM students WHERE id = ?",
-                (current_submission['student_id'],)
-            )[0]
+            # Save the grade and mark the submission as graded in one transaction
+            await db.execute_transaction_async([
+                ("INSERT INTO grades (submission_id, module_id, student_id, score) VALUES (?, ?, ?, ?)",
+                 (current_submission['id'], current_submission['module_id'], current_submission['student_id'], grade)),
+                ("UPDATE submissions SET is_graded = TRUE WHERE id = ?",
+                 (current_submission['id'],)),
+            ])
+            student_handlers.invalidate_leaderboard(current_submission['group_id'])
 
             await update.message.reply_text(
                 f"✅ Baho saqlandi!\n\n"
-                f"👤 Talaba: {student_info['fullname']}\n"
+                f"👤 Talaba: {current_submission['student_name']}\n"
                 f"📊 Baho: {grade}/100\n"
-                f"📖 Modul: #{module_info['module_number']}"
+                f"📖 Modul: #{current_submission['module_number']}"
             )
 
             # Continue with next submission
             remaining_submissions = context.user_data.get('remaining_submissions', [])
-            await TeacherHandlers._show_next_submission(update, context, remaining_submissions)
+            return await TeacherHandlers._show_next_submission(update, context, remaining_submissions)
 
-        except Exception as e:
-            print(f"Error processing grade: {e}")
+        except Exception:
+            logger.exception("Error processing grade")
             await update.message.reply_text(config.MESSAGES['something_wrong'])
+            return WAITING_GRADE
 
     @staticmethod
     async def start_create_group(update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Begin group creation process"""
         await update.message.reply_text(
             config.MESSAGES['enter_group_name'],
-            reply_markup=TeacherHandlers._get_cancel_keyboard()
+            reply_markup=_CANCEL_MARKUP
         )
         return WAITING_GROUP_NAME
 
@@ -607,7 +724,7 @@ class TeacherHandlers:
         """Store group name and ask for channel ID"""
         group_name = update.message.text.strip()
 
-        if group_name == config.BUTTONS['cancel']:
+        if group_name == _CANCEL:
             await TeacherHandlers.cancel_operation(update, context)
             return ConversationHandler.END
 
@@ -615,7 +732,7 @@ class TeacherHandlers:
 
         await update.message.reply_text(
             config.MESSAGES['enter_channel_id'],
-            reply_markup=TeacherHandlers._get_cancel_keyboard()
+            reply_markup=_CANCEL_MARKUP
         )
         return WAITING_CHANNEL_ID
 
@@ -625,7 +742,7 @@ class TeacherHandlers:
         try:
             channel_id = update.message.text.strip()
 
-            if channel_id == config.BUTTONS['cancel']:
+            if channel_id == _CANCEL:
                 await TeacherHandlers.cancel_operation(update, context)
                 return ConversationHandler.END
 
@@ -633,16 +750,17 @@ class TeacherHandlers:
             teacher_phone = context.user_data.get('user_phone')
 
             # Get teacher ID
-            teacher = auth._get_teacher_by_phone(teacher_phone)
+            teacher = await asyncio.to_thread(auth._get_teacher_by_phone, teacher_phone)
             if not teacher:
                 await update.message.reply_text("❌ O'qituvchi ma'lumotlari topilmadi.")
                 return ConversationHandler.END
 
             # Create the group
-            group_id = db.execute_query(
+            group_id = await db.execute_query_async(
                 "INSERT INTO groups (name, channel_id, teacher_id) VALUES (?, ?, ?)",
                 (group_name, channel_id, teacher['id'])
             )
+            TeacherHandlers._teacher_groups_cache.pop(teacher_phone, None)
 
             await update.message.reply_text(
                 f"✅ Guruh muvaffaqiyatli yaratildi!\n\n"
@@ -651,26 +769,26 @@ class TeacherHandlers:
                 f"🔢 Guruh ID: {group_id}"
             )
 
-            context.user_data.clear()
+            TeacherHandlers._drop_flow_data(context)
             await TeacherHandlers.show_teacher_menu(update, context)
             return ConversationHandler.END
 
-        except Exception as e:
-            print(f"Error creating group: {e}")
+        except Exception:
+            logger.exception("Error creating group")
             await update.message.reply_text(config.MESSAGES['something_wrong'])
             return ConversationHandler.END
 
     @staticmethod
     async def start_add_student(update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Begin student addition process"""
-        session = auth.get_user_session(update.effective_user.id)
+        session = await TeacherHandlers.get_session(update, context)
         if not session:
             await update.message.reply_text("❌ Guruh tanlanmagan.")
             return ConversationHandler.END
 
         await update.message.reply_text(
             config.MESSAGES['enter_student_name'],
-            reply_markup=TeacherHandlers._get_cancel_keyboard()
+            reply_markup=_CANCEL_MARKUP
         )
         return WAITING_STUDENT_NAME
 
@@ -679,7 +797,7 @@ class TeacherHandlers:
         """Store student name and ask for phone"""
         student_name = update.message.text.strip()
 
-        if student_name == config.BUTTONS['cancel']:
+        if student_name == _CANCEL:
             await TeacherHandlers.cancel_operation(update, context)
             return ConversationHandler.END
 
@@ -687,7 +805,7 @@ class TeacherHandlers:
 
         await update.message.reply_text(
             config.MESSAGES['enter_student_phone'],
-            reply_markup=TeacherHandlers._get_cancel_keyboard()
+            reply_markup=_CANCEL_MARKUP
         )
         return WAITING_STUDENT_PHONE
 
@@ -697,17 +815,17 @@ class TeacherHandlers:
         try:
             student_phone = update.message.text.strip()
 
-            if student_phone == config.BUTTONS['cancel']:
+            if student_phone == _CANCEL:
                 await TeacherHandlers.cancel_operation(update, context)
                 return ConversationHandler.END
 
-            session = auth.get_user_session(update.effective_user.id)
+            session = await TeacherHandlers.get_session(update, context)
             student_name = context.user_data.get('student_name')
-            formatted_phone = config.format_phone(student_phone)
+            formatted_phone = format_phone(student_phone)
 
             # Check if student already exists in this group
-            existing_student = db.execute_query(
-                "SELECT id FROM students WHERE phone_number = ? AND group_id = ?",
+            existing_student = await db.execute_query_async(
+                "SELECT 1 FROM students WHERE phone_number = ? AND group_id = ? LIMIT 1",
                 (formatted_phone, session['selected_group_id'])
             )
 
@@ -715,10 +833,13 @@ class TeacherHandlers:
                 await update.message.reply_text("❌ Bu talaba allaqachon guruhda mavjud!")
             else:
                 # Add student to group
-                student_id = db.execute_query(
+                student_id = await db.execute_query_async(
                     "INSERT INTO students (fullname, phone_number, group_id) VALUES (?, ?, ?)",
                     (student_name, formatted_phone, session['selected_group_id'])
                 )
+                # The cached group list carries the student counts
+                TeacherHandlers._teacher_groups_cache.pop(context.user_data.get('user_phone'), None)
+                auth.invalidate_user_types()
 
                 await update.message.reply_text(
                     f"✅ Talaba guruhga qo'shildi!\n\n"
@@ -727,24 +848,27 @@ class TeacherHandlers:
                     f"🆔 ID: {student_id}"
                 )
 
-            context.user_data.clear()
+            TeacherHandlers._drop_flow_data(context)
             return ConversationHandler.END
 
-        except Exception as e:
-            print(f"Error adding student: {e}")
+        except Exception:
+            logger.exception("Error adding student")
             await update.message.reply_text(config.MESSAGES['something_wrong'])
             return ConversationHandler.END
 
     @staticmethod
+    @functools.lru_cache(maxsize=256)
     def _get_grading_keyboard(remaining_count):
-        """Create keyboard for grading workflow"""
-        keyboard = []
-        if remaining_count > 0:
-            keyboard.append([KeyboardButton(f"📊 Keyingi ish ({remaining_count} qoldi)")])
-        keyboard.append([KeyboardButton("⏸ Keyinroq baholash")])
+        """
+        Create keyboard for grading workflow; only the "next" label depends on the remaining count,
+        so each count's keyboard is built once and reused.
+        """
+        if remaining_count <= 0:
+            return _LAST_SUBMISSION_MARKUP
 
         return ReplyKeyboardMarkup(
-            keyboard,
+            [[KeyboardButton(f"📊 {_NEXT_SUBMISSION_MARKER} ({remaining_count} qoldi)")],
+             [KeyboardButton(_PAUSE_GRADING_TEXT)]],
             resize_keyboard=True,
             one_time_keyboard=True
         )
@@ -1,33 +1,214 @@
+import asyncio
+import atexit
+import itertools
 import logging
+import queue
+import sqlite3
+import time
+from logging.handlers import QueueHandler, QueueListener
+from urllib.parse import urlsplit
+
 from telegram import Update, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove
+from telegram.error import TelegramError
 from telegram.ext import (
-    Application, CommandHandler, MessageHandler, ConversationHandler,
-    ContextTypes, filters
+    Application, BaseUpdateProcessor, CommandHandler, MessageHandler, ConversationHandler,
+    ContextTypes, PicklePersistence, TypeHandler, filters
 )
+from telegram.request import HTTPXRequest
+
+try:
+    import orjson
+except ImportError:  # Optional speed-up; the stdlib json parser is used without it
+    orjson = None
 
 # Import our custom modules
 from database import db
-from config import config
-from auth.auth import auth
-from handlers.admin_handlers import admin_handlers, WAITING_TEACHER_NAME, WAITING_TEACHER_PHONE, CONFIRMING_DELETE
+from config import config, format_phone, validate_configuration
+from auth.auth import auth, USER_TYPE_CACHE_TTL
+from handlers import admin_handlers
+from handlers.admin_handlers import WAITING_TEACHER_NAME, WAITING_TEACHER_PHONE, CONFIRMING_DELETE
 from handlers.teacher_handlers import (
-    teacher_handlers,
+    teacher_handlers, GRADE_INPUT_FILTER,
     WAITING_GROUP_NAME, WAITING_CHANNEL_ID, WAITING_STUDENT_NAME, WAITING_STUDENT_PHONE,
     WAITING_TASK_DESCRIPTION, WAITING_TASK_PHOTOS, WAITING_GRADE
 )
 from handlers.student_handlers import student_handlers, WAITING_SUBMISSION_DESCRIPTION, WAITING_SUBMISSION_PHOTOS
 
-# Configure logging to track bot behavior and debug issues
+# Configure logging to track bot behavior and debug issues.
+# Handlers only enqueue records; a background listener thread does the actual writing,
+# so a slow stdout or log pipe never blocks the event loop.
+_log_queue = queue.SimpleQueue()
+_console_handler = logging.StreamHandler()
+_console_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
 logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    handlers=[QueueHandler(_log_queue)],
     level=logging.INFO
 )
+_log_listener = QueueListener(_log_queue, _console_handler)
+_log_listener.start()
+atexit.register(_log_listener.stop)
 logger = logging.getLogger(__name__)
 
 # Conversation state for phone number collection
 WAITING_PHONE = 1
 
 
+class OrjsonRequest(HTTPXRequest):
+    """HTTPXRequest that parses Telegram's JSON responses with orjson"""
+
+    @staticmethod
+    def parse_json_payload(payload: bytes):
+        try:
+            return orjson.loads(payload)
+        except orjson.JSONDecodeError as exc:
+            raise TelegramError("Invalid server response") from exc
+
+
+_REQUEST_CLASS = OrjsonRequest if orjson else HTTPXRequest
+
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """
+    Processes updates from different chats concurrently, but the updates of one chat strictly
+    one after another in arrival order, so a user's conversation state never races with itself.
+    """
+
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        # chat_id -> [lock, number of updates holding or waiting for it]
+        self._chat_locks = {}
+
+    async def process_update(self, update, coroutine):
+        chat = update.effective_chat if isinstance(update, Update) else None
+        if chat is None:
+            await super().process_update(update, coroutine)
+            return
+
+        entry = self._chat_locks.setdefault(chat.id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            # The chat lock is taken before the shared concurrency slot (super().process_update),
+            # so updates queued behind their own chat never hold a slot other chats could use.
+            # asyncio.Lock wakes waiters in FIFO order, which keeps the chat's updates in order.
+            async with entry[0]:
+                await super().process_update(update, coroutine)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._chat_locks[chat.id]
+
+    async def do_process_update(self, update, coroutine):
+        await coroutine
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+
+# Every handler reacts to messages only (text, contact, photo); Telegram need not send anything else
+_ALLOWED_UPDATES = [Update.MESSAGE]
+
+# Within this many seconds of the phone prompt, a repeated /start is answered by the prompt
+# already on screen instead of a new message
+_PHONE_PROMPT_REPEAT_WINDOW = 60
+
+# Message texts, rendered once; only the welcome needs the user's name per call
+_WELCOME_TEMPLATE = (
+    "👋 Assalomu alaykum, {name}!\n\n"
+    "Ta'lim boshqaruv tizimiga xush kelibsiz!\n"
+    "Davom etish uchun telefon raqamingizni yuborishingiz kerak.\n\n"
+    "📱 Pastdagi tugmani bosing yoki raqamingizni yozing:"
+)
+_AUTH_FAILED_TEXT = f"{config.MESSAGES['auth_failed']}\n\n{config.MESSAGES['contact_support']}"
+_ERROR_TEXT = f"{config.MESSAGES['something_wrong']}\n\nAgar muammo davom etsa, /start buyrug'ini yuboring."
+_NOT_AUTHENTICATED_TEXT = "❓ Avval /start buyrug'ini yuboring va telefon raqamingizni tasdiqqlang."
+_UNKNOWN_COMMAND_TEXT = "❓ Noma'lum buyruq. Iltimos, tugmalardan foydalaning yoki /start buyrug'ini yuboring."
+
+# Contact request keyboard shown by /start
+_CONTACT_MARKUP = ReplyKeyboardMarkup(
+    [[KeyboardButton(config.MESSAGES['contact_button'], request_contact=True)]],
+    resize_keyboard=True,
+    one_time_keyboard=True
+)
+
+# Hides the contact keyboard when no other keyboard follows (failed authentication)
+_REMOVE_KEYBOARD = ReplyKeyboardRemove()
+
+
+# Role selection button text and description for each role, in the order auth lists roles
+_ROLE_DESCRIPTIONS = {
+    'admin': ('👨‍💼 Admin sifatida kirish', 'Tizimni boshqarish va o\'qituvchilarni yaratish'),
+    'teacher': ('👨‍🏫 O\'qituvchi sifatida kirish', 'Guruhlar va vazifalarni boshqarish'),
+    'student': ('👨‍🎓 Talaba sifatida kirish', 'Vazifalarni bajarish va natijalarni ko\'rish')
+}
+
+
+def _build_role_selection(roles):
+    """Role selection message and keyboard for one combination of roles"""
+    reply_markup = ReplyKeyboardMarkup(
+        [[KeyboardButton(_ROLE_DESCRIPTIONS[role][0])] for role in roles],
+        resize_keyboard=True,
+        one_time_keyboard=True
+    )
+
+    message = (
+            f"🎯 Sizda bir necha rol mavjud!\n\n"
+            f"Quyidagi rollardan birini tanlang:\n" +
+            "\n".join(f"• {_ROLE_DESCRIPTIONS[role][1]}" for role in roles) +
+            f"\n\nBu sessiya davomida tanlangan rol bilan ishlaysiz. "
+            f"Keyin boshqa rolga o'tish mumkin."
+    )
+    return message, reply_markup
+
+
+# Role selection button text -> role type
+_ROLE_MAPPING = {
+    config.BUTTONS['select_admin_role']: 'admin',
+    config.BUTTONS['select_teacher_role']: 'teacher',
+    config.BUTTONS['select_student_role']: 'student'
+}
+
+# Only three roles exist, so every multi-role combination (four of them) is rendered once
+_ROLE_SELECTIONS = {
+    frozenset(roles): _build_role_selection(roles)
+    for roles in itertools.chain.from_iterable(
+        itertools.combinations(_ROLE_DESCRIPTIONS, count) for count in (2, 3)
+    )
+}
+
+
+# Plain text that isn't a /command; one shared filter object for every text state and handler
+_TEXT_NO_COMMAND = filters.TEXT & ~filters.COMMAND
+
+
+def _button_filter(key):
+    """Filter matching exactly one button text - a string comparison, no regex"""
+    return filters.Text([config.BUTTONS[key]])
+
+
+# Conversation entry points and the cancel fallback shared by every conversation, built once
+_CREATE_TEACHER_FILTER = _button_filter('create_teacher')
+_DELETE_TEACHER_FILTER = _button_filter('delete_teacher')
+_CREATE_GROUP_FILTER = _button_filter('create_group')
+_ADD_STUDENT_FILTER = _button_filter('add_student')
+_CREATE_TASK_FILTER = _button_filter('create_task')
+_SUBMIT_TASK_FILTER = _button_filter('submit_task')
+_GRADE_SUBMISSIONS_FILTER = _button_filter('grade_submissions')
+_CANCEL_FILTER = _button_filter('cancel')
+
+# Single-action buttons (no conversation needed), dispatched with one dict lookup
+BUTTON_HANDLERS = {
+    config.BUTTONS['view_teachers']: admin_handlers.view_all_teachers,
+    config.BUTTONS['my_groups']: teacher_handlers.show_my_groups,
+    config.BUTTONS['create_module']: teacher_handlers.create_new_module,
+    config.BUTTONS['current_task']: student_handlers.show_current_task,
+    config.BUTTONS['my_progress']: student_handlers.show_my_progress,
+    config.BUTTONS['leaderboard']: student_handlers.show_leaderboard,
+}
+
+
 class EducationBot:
     """
     Main orchestrator for our education management system.
@@ -42,9 +223,45 @@ class EducationBot:
     its interface and capabilities based on who is using it.
     """
 
+    # Created once per process; fixed attributes, no per-instance __dict__
+    __slots__ = ('app', '_text_dispatch')
+
     def __init__(self):
         """Initialize the bot application with all necessary handlers"""
-        self.app = Application.builder().token(config.BOT_TOKEN).build()
+        # Persist conversation states and user_data so in-flight workflows survive a restart
+        persistence = PicklePersistence(filepath=config.PERSISTENCE_PATH)
+        self.app = (
+            Application.builder()
+            .token(config.BOT_TOKEN)
+            .persistence(persistence)
+            # Room for bursts of replies, channel posts and albums without waiting for a free connection
+            .request(_REQUEST_CLASS(
+                connection_pool_size=256,
+                pool_timeout=30.0,
+                connect_timeout=10.0,
+                read_timeout=30.0
+            ))
+            # getUpdates gets its own pool so long polling never competes with outgoing calls
+            .get_updates_request(_REQUEST_CLASS(
+                connection_pool_size=32,
+                pool_timeout=30.0
+            ))
+            # Handle updates from different chats side by side; each chat's own updates stay in order
+            .concurrent_updates(PerChatUpdateProcessor(256))
+            .post_init(self._on_startup)
+            .post_shutdown(self._on_shutdown)
+            .build()
+        )
+
+        # Exact-text menu buttons -> handler(update, context, user_type)
+        self._text_dispatch = {
+            config.COMMANDS['menu']: self._show_main_menu,
+            config.BUTTONS['back']: self._handle_back_button,
+            config.BUTTONS['back_to_groups']: lambda update, context, user_type:
+                teacher_handlers.show_my_groups(update, context),
+            config.BUTTONS['switch_role']: lambda update, context, user_type:
+                self._handle_role_switch(update, context),
+        }
         self._setup_handlers()
 
     def _setup_handlers(self):
@@ -59,158 +276,86 @@ class EducationBot:
             states={
                 WAITING_PHONE: [
                     MessageHandler(filters.CONTACT, self.receive_phone_contact),
-                    MessageHandler(filters.TEXT & ~filters.COMMAND, self.receive_phone_text)
+                    MessageHandler(_TEXT_NO_COMMAND, self.receive_phone_text)
                 ]
             },
-            fallbacks=[CommandHandler('start', self.start_command)]
+            fallbacks=[CommandHandler('start', self._repeat_start)],
+            name='auth',
+            persistent=True
         )
 
-        # Admin workflow conversations
-        admin_teacher_conversation = ConversationHandler(
-            entry_points=[MessageHandler(
-                filters.Regex(f"^{config.BUTTONS['create_teacher']}$"),
-                admin_handlers.start_create_teacher
-            )],
-            states={
-                WAITING_TEACHER_NAME: [MessageHandler(filters.TEXT, admin_handlers.receive_teacher_name)],
-                WAITING_TEACHER_PHONE: [MessageHandler(filters.TEXT, admin_handlers.receive_teacher_phone)]
-            },
-            fallbacks=[MessageHandler(
-                filters.Regex(f"^{config.BUTTONS['cancel']}$"),
-                admin_handlers.cancel_operation
-            )]
-        )
-
-        admin_delete_conversation = ConversationHandler(
-            entry_points=[MessageHandler(
-                filters.Regex(f"^{config.BUTTONS['delete_teacher']}$"),
-                admin_handlers.start_delete_teacher
-            )],
-            states={
-                CONFIRMING_DELETE: [MessageHandler(filters.TEXT, admin_handlers.confirm_delete_teacher)]
-            },
-            fallbacks=[MessageHandler(
-                filters.Regex(f"^{config.BUTTONS['cancel']}$"),
-                admin_handlers.cancel_operation
-            )]
-        )
-
-        # Teacher workflow conversations
-        teacher_group_conversation = ConversationHandler(
-            entry_points=[MessageHandler(
-                filters.Regex(f"^{config.BUTTONS['create_group']}$"),
-                teacher_handlers.start_create_group
-            )],
-            states={
-                WAITING_GROUP_NAME: [MessageHandler(filters.TEXT, teacher_handlers.receive_group_name)],
-                WAITING_CHANNEL_ID: [MessageHandler(filters.TEXT, teacher_handlers.receive_channel_id)]
-            },
-            fallbacks=[MessageHandler(
-                filters.Regex(f"^{config.BUTTONS['cancel']}$"),
-                teacher_handlers.cancel_operation
-            )]
-        )
-
-        teacher_student_conversation = ConversationHandler(
-            entry_points=[MessageHandler(
-                filters.Regex(f"^{config.BUTTONS['add_student']}$"),
-                teacher_handlers.start_add_student
-            )],
-            states={
-                WAITING_STUDENT_NAME: [MessageHandler(filters.TEXT, teacher_handlers.receive_student_name)],
-                WAITING_STUDENT_PHONE: [MessageHandler(filters.TEXT, teacher_handlers.receive_student_phone)]
-            },
-            fallbacks=[MessageHandler(
-                filters.Regex(f"^{config.BUTTONS['cancel']}$"),
-                teacher_handlers.cancel_operation
-            )]
-        )
-
-        teacher_task_conversation = ConversationHandler(
-            entry_points=[MessageHandler(
-                filters.Regex(f"^{config.BUTTONS['create_task']}$"),
-                teacher_handlers.start_create_task
-            )],
-            states={
-                WAITING_TASK_DESCRIPTION: [MessageHandler(filters.TEXT, teacher_handlers.receive_task_description)],
+        # Button-started workflow conversations:
+        # (name, entry filter, entry callback, {state: [(filter, callback), ...]}, cancel callback)
+        button_conversations = [
+            # Admin workflows
+            ('admin_teacher', _CREATE_TEACHER_FILTER, admin_handlers.start_create_teacher, {
+                WAITING_TEACHER_NAME: [(_TEXT_NO_COMMAND, admin_handlers.receive_teacher_name)],
+                WAITING_TEACHER_PHONE: [(_TEXT_NO_COMMAND, admin_handlers.receive_teacher_phone)]
+            }, admin_handlers.cancel_operation),
+            ('admin_delete', _DELETE_TEACHER_FILTER, admin_handlers.start_delete_teacher, {
+                CONFIRMING_DELETE: [(_TEXT_NO_COMMAND, admin_handlers.confirm_delete_teacher)]
+            }, admin_handlers.cancel_operation),
+
+            # Teacher workflows
+            ('teacher_group', _CREATE_GROUP_FILTER, teacher_handlers.start_create_group, {
+                WAITING_GROUP_NAME: [(_TEXT_NO_COMMAND, teacher_handlers.receive_group_name)],
+                WAITING_CHANNEL_ID: [(_TEXT_NO_COMMAND, teacher_handlers.receive_channel_id)]
+            }, teacher_handlers.cancel_operation),
+            ('teacher_student', _ADD_STUDENT_FILTER, teacher_handlers.start_add_student, {
+                WAITING_STUDENT_NAME: [(_TEXT_NO_COMMAND, teacher_handlers.receive_student_name)],
+                WAITING_STUDENT_PHONE: [(_TEXT_NO_COMMAND, teacher_handlers.receive_student_phone)]
+            }, teacher_handlers.cancel_operation),
+            ('teacher_task', _CREATE_TASK_FILTER, teacher_handlers.start_create_task, {
+                WAITING_TASK_DESCRIPTION: [(_TEXT_NO_COMMAND, teacher_handlers.receive_task_description)],
                 WAITING_TASK_PHOTOS: [
-                    MessageHandler(filters.PHOTO, teacher_handlers.receive_task_photos),
-                    MessageHandler(filters.TEXT, teacher_handlers.receive_task_photos)
+                    (filters.PHOTO, teacher_handlers.receive_task_photos),
+                    (_TEXT_NO_COMMAND, teacher_handlers.receive_task_photos)
                 ]
-            },
-            fallbacks=[MessageHandler(
-                filters.Regex(f"^{config.BUTTONS['cancel']}$"),
-                teacher_handlers.cancel_operation
-            )]
-        )
+            }, teacher_handlers.cancel_operation),
 
-        # Student workflow conversations
-        student_submission_conversation = ConversationHandler(
-            entry_points=[MessageHandler(
-                filters.Regex(f"^{config.BUTTONS['submit_task']}$"),
-                student_handlers.start_submit_task
-            )],
-            states={
-                WAITING_SUBMISSION_DESCRIPTION: [
-                    MessageHandler(filters.TEXT, student_handlers.receive_submission_description)],
+            # Student workflows
+            ('student_submission', _SUBMIT_TASK_FILTER, student_handlers.start_submit_task, {
+                WAITING_SUBMISSION_DESCRIPTION: [(_TEXT_NO_COMMAND, student_handlers.receive_submission_description)],
                 WAITING_SUBMISSION_PHOTOS: [
-                    MessageHandler(filters.PHOTO, student_handlers.receive_submission_photos),
-                    MessageHandler(filters.TEXT, student_handlers.receive_submission_photos)
+                    (filters.PHOTO, student_handlers.receive_submission_photos),
+                    (_TEXT_NO_COMMAND, student_handlers.receive_submission_photos)
                 ]
-            },
-            fallbacks=[MessageHandler(
-                filters.Regex(f"^{config.BUTTONS['cancel']}$"),
-                student_handlers.cancel_operation
-            )]
-        )
+            }, student_handlers.cancel_operation),
+        ]
+
+        # Before anything else (group -1): re-verify persisted roles that have gone stale
+        self.app.add_handler(TypeHandler(Update, self._recheck_auth), group=-1)
 
         # Register all conversation handlers
         self.app.add_handler(auth_conversation)
-        self.app.add_handler(admin_teacher_conversation)
-        self.app.add_handler(admin_delete_conversation)
-        self.app.add_handler(teacher_group_conversation)
-        self.app.add_handler(teacher_student_conversation)
-        self.app.add_handler(teacher_task_conversation)
-        self.app.add_handler(student_submission_conversation)
-
-        # Single-action message handlers (no conversation needed)
-        self.app.add_handler(MessageHandler(
-            filters.Regex(f"^{config.BUTTONS['view_teachers']}$"),
-            admin_handlers.view_all_teachers
-        ))
-        self.app.add_handler(MessageHandler(
-            filters.Regex(f"^{config.BUTTONS['my_groups']}$"),
-            teacher_handlers.show_my_groups
-        ))
-        self.app.add_handler(MessageHandler(
-            filters.Regex(f"^{config.BUTTONS['create_module']}$"),
-            teacher_handlers.create_new_module
-        ))
-        self.app.add_handler(MessageHandler(
-            filters.Regex(f"^{config.BUTTONS['grade_submissions']}$"),
-            teacher_handlers.start_grading
-        ))
-        self.app.add_handler(MessageHandler(
-            filters.Regex(f"^{config.BUTTONS['current_task']}$"),
-            student_handlers.show_current_task
-        ))
-        self.app.add_handler(MessageHandler(
-            filters.Regex(f"^{config.BUTTONS['my_progress']}$"),
-            student_handlers.show_my_progress
-        ))
-        self.app.add_handler(MessageHandler(
-            filters.Regex(f"^{config.BUTTONS['leaderboard']}$"),
-            student_handlers.show_leaderboard
-        ))
-
-        # Special handler for teacher grading workflow (handles grade input)
-        self.app.add_handler(MessageHandler(
-            filters.TEXT & filters.Regex(r'^\d+$'),  # Numbers only for grades
-            self.handle_grade_input
+        for name, entry_filter, entry_callback, states, cancel_callback in button_conversations:
+            self.app.add_handler(ConversationHandler(
+                entry_points=[MessageHandler(entry_filter, entry_callback)],
+                states={
+                    state: [MessageHandler(state_filter, callback) for state_filter, callback in handlers]
+                    for state, handlers in states.items()
+                },
+                fallbacks=[MessageHandler(_CANCEL_FILTER, cancel_callback)],
+                name=name,
+                persistent=True
+            ))
+
+        # Teacher grading: grade input is only matched while a teacher is in the grading state.
+        # Other text falls through to the menu handlers, and pressing the grading button again
+        # restarts the queue, so the state never traps the teacher.
+        self.app.add_handler(ConversationHandler(
+            entry_points=[MessageHandler(_GRADE_SUBMISSIONS_FILTER, teacher_handlers.start_grading)],
+            states={
+                WAITING_GRADE: [MessageHandler(GRADE_INPUT_FILTER, teacher_handlers.receive_grade)]
+            },
+            fallbacks=[MessageHandler(_CANCEL_FILTER, teacher_handlers.cancel_operation)],
+            name='teacher_grading',
+            persistent=True,
+            allow_reentry=True
         ))
 
-        # Generic message handler for menu navigation and group selection
-        self.app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, self.handle_text_message))
+        # Generic message handler: single-action buttons, menu navigation and group selection
+        self.app.add_handler(MessageHandler(_TEXT_NO_COMMAND, self.handle_text_message))
 
         # Error handler for graceful error management
         self.app.add_error_handler(self.error_handler)
@@ -225,23 +370,36 @@ class EducationBot:
         # Clear any existing context when starting fresh
         context.user_data.clear()
 
+        # Returning user whose roles are still cached - no need to ask for the phone again
+        cached_phone = auth.get_cached_phone(user.id)
+        if cached_phone:
+            await self._authenticate_user(update, context, cached_phone)
+            return ConversationHandler.END
+
         # Welcome message with clear instructions
-        welcome_message = (
-            f"👋 Assalomu alaykum, {user.first_name}!\n\n"
-            f"Ta'lim boshqaruv tizimiga xush kelibsiz!\n"
-            f"Davom etish uchun telefon raqamingizni yuborishingiz kerak.\n\n"
-            f"📱 Pastdagi tugmani bosing yoki raqamingizni yozing:"
-        )
+        welcome_message = _WELCOME_TEMPLATE.format(name=user.first_name)
 
-        # Create contact request keyboard
-        keyboard = [[KeyboardButton(config.MESSAGES['contact_button'], request_contact=True)]]
-        reply_markup = ReplyKeyboardMarkup(
-            keyboard,
-            resize_keyboard=True,
-            one_time_keyboard=True
-        )
+        await update.message.reply_text(welcome_message, reply_markup=_CONTACT_MARKUP)
+        context.user_data['phone_prompt_at'] = time.time()
+        return WAITING_PHONE
 
-        await update.message.reply_text(welcome_message, reply_markup=reply_markup)
+    @staticmethod
+    async def _repeat_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """
+        /start again while we are already waiting for the phone number. A quick repeat just
+        keeps waiting - the prompt and its contact keyboard are still on screen. Only when that
+        prompt may be gone (no record of it, e.g. from before a restart, or it is older than
+        _PHONE_PROMPT_REPEAT_WINDOW after a cleared history / "Restart bot") is it sent again.
+        """
+        prompted_at = context.user_data.get('phone_prompt_at')
+        if prompted_at and time.time() - prompted_at < _PHONE_PROMPT_REPEAT_WINDOW:
+            return WAITING_PHONE
+
+        await update.message.reply_text(
+            _WELCOME_TEMPLATE.format(name=update.effective_user.first_name),
+            reply_markup=_CONTACT_MARKUP
+        )
+        context.user_data['phone_prompt_at'] = time.time()
         return WAITING_PHONE
 
     async def receive_phone_contact(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -265,7 +423,7 @@ class EducationBot:
         This provides an alternative for users who prefer typing.
         """
         phone_number = update.message.text.strip()
-        formatted_phone = config.format_phone(phone_number)
+        formatted_phone = format_phone(phone_number)
 
         await self._authenticate_user(update, context, formatted_phone)
         return ConversationHandler.END
@@ -291,19 +449,11 @@ class EducationBot:
             # Store phone number for later use in workflows
             context.user_data['user_phone'] = phone_number
 
-            # Remove the contact keyboard - we'll show appropriate interface next
-            await update.message.reply_text(
-                "✅ Telefon raqami qabul qilindi...",
-                reply_markup=ReplyKeyboardRemove()
-            )
-
-            # Handle the authentication result
+            # No separate "phone received" message: the role selection or menu keyboard sent
+            # next replaces the contact keyboard, and the refusal below removes it
             if auth_result is None:
                 # User not authorized - provide helpful guidance
-                await update.message.reply_text(
-                    f"{config.MESSAGES['auth_failed']}\n\n"
-                    f"{config.MESSAGES['contact_support']}"
-                )
+                await update.message.reply_text(_AUTH_FAILED_TEXT, reply_markup=_REMOVE_KEYBOARD)
                 return
 
             # Check if this is a dual-role scenario
@@ -316,10 +466,36 @@ class EducationBot:
             # Single role scenario - proceed directly to the appropriate interface
             await self._activate_role(update, context, auth_result)
 
-        except Exception as e:
-            logger.error(f"Authentication error: {e}")
+        except (sqlite3.Error, TelegramError) as e:
+            # Anything else is a bug and goes to error_handler with its traceback
+            logger.error("Authentication error: %s", e)
             await update.message.reply_text(config.MESSAGES['something_wrong'])
 
+    async def _recheck_auth(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """
+        user_data is persisted, so the role and the student/group rows cached in it would
+        otherwise never expire. Once the last check is older than USER_TYPE_CACHE_TTL, the
+        user's roles are verified again: a role that is still held is kept (its cached rows are
+        re-read), a role that is gone logs the user out.
+        """
+        user_type = context.user_data.get('user_type') if context.user_data else None
+        if not user_type or time.time() - context.user_data.get('auth_checked_at', 0) < USER_TYPE_CACHE_TTL:
+            return
+
+        user_phone = context.user_data.get('user_phone')
+        auth_result = user_phone and await auth.get_user_type(update.effective_user.id, user_phone, context.bot)
+        if isinstance(auth_result, dict):
+            roles = auth_result['available_roles']
+        else:
+            roles = [auth_result]
+
+        if user_type in roles:
+            context.user_data['auth_checked_at'] = time.time()
+            context.user_data.pop('student', None)
+            context.user_data.pop('group', None)
+        else:
+            context.user_data.clear()
+
     async def _show_role_selection(self, update: Update, context: ContextTypes.DEFAULT_TYPE, available_roles):
         """
         Display role selection interface for users with multiple roles.
@@ -328,41 +504,7 @@ class EducationBot:
         which capacity they want to work in for this session. The design philosophy
         here is to make the choice clear and avoid confusion about current permissions.
         """
-        # Create dynamic keyboard based on available roles
-        keyboard = []
-
-        role_descriptions = {
-            'admin': ('👨‍💼 Admin sifatida kirish', 'Tizimni boshqarish va o\'qituvchilarni yaratish'),
-            'teacher': ('👨‍🏫 O\'qituvchi sifatida kirish', 'Guruhlar va vazifalarni boshqarish'),
-            'student': ('👨‍🎓 Talaba sifatida kirish', 'Vazifalarni bajarish va natijalarni ko\'rish')
-        }
-
-        for role in available_roles:
-            if role in role_descriptions:
-                button_text, description = role_descriptions[role]
-                keyboard.append([KeyboardButton(button_text)])
-
-        reply_markup = ReplyKeyboardMarkup(
-            keyboard,
-            resize_keyboard=True,
-            one_time_keyboard=True
-        )
-
-        # Create a welcoming message that explains the choice
-        role_list = []
-        for role in available_roles:
-            if role in role_descriptions:
-                _, description = role_descriptions[role]
-                role_list.append(f"• {description}")
-
-        message = (
-                f"🎯 Sizda bir necha rol mavjud!\n\n"
-                f"Quyidagi rollardan birini tanlang:\n" +
-                "\n".join(role_list) +
-                f"\n\nBu sessiya davomida tanlangan rol bilan ishlaysiz. "
-                f"Keyin boshqa rolga o'tish mumkin."
-        )
-
+        message, reply_markup = _ROLE_SELECTIONS[frozenset(available_roles)]
         await update.message.reply_text(message, reply_markup=reply_markup)
 
     async def _activate_role(self, update: Update, context: ContextTypes.DEFAULT_TYPE, user_type):
@@ -373,6 +515,8 @@ class EducationBot:
         handle both single-role users and dual-role users who have made their selection.
         """
         context.user_data['user_type'] = user_type
+        # Wall-clock time, since user_data (and so this stamp) survives restarts
+        context.user_data['auth_checked_at'] = time.time()
 
         # Route to appropriate interface based on user type
         if user_type == 'admin':
@@ -384,10 +528,13 @@ class EducationBot:
             await teacher_handlers.show_teacher_menu(update, context)
 
         elif user_type == 'student':
+            # Student handlers re-read these once for the new session and reuse them afterwards
+            context.user_data.pop('student', None)
+            context.user_data.pop('group', None)
             await update.message.reply_text(config.MESSAGES['welcome_student'])
             await student_handlers.show_student_menu(update, context)
 
-    async def _handle_role_selection(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+    async def _handle_role_selection(self, update: Update, context: ContextTypes.DEFAULT_TYPE, available_roles):
         """
         Process role selection from users with multiple roles.
 
@@ -396,16 +543,9 @@ class EducationBot:
         and provide immediate feedback about the selected role.
         """
         selected_text = update.message.text.strip()
-        available_roles = context.user_data.get('available_roles', [])
 
         # Map button text back to role types
-        role_mapping = {
-            config.BUTTONS['select_admin_role']: 'admin',
-            config.BUTTONS['select_teacher_role']: 'teacher',
-            config.BUTTONS['select_student_role']: 'student'
-        }
-
-        selected_role = role_mapping.get(selected_text)
+        selected_role = _ROLE_MAPPING.get(selected_text)
 
         if selected_role and selected_role in available_roles:
             # Valid role selection - activate it
@@ -428,38 +568,37 @@ class EducationBot:
         to determine the most appropriate response to their message.
         """
         text = update.message.text.strip()
+
+        # Single-action buttons (no conversation needed) - one dict lookup
+        button_handler = BUTTON_HANDLERS.get(text)
+        if button_handler:
+            await button_handler(update, context)
+            return
+
         user_type = context.user_data.get('user_type')
 
         try:
             # Priority 1: Handle role selection if user is in that state
-            if 'available_roles' in context.user_data:
-                await self._handle_role_selection(update, context)
+            available_roles = context.user_data.get('available_roles')
+            if available_roles:
+                await self._handle_role_selection(update, context, available_roles)
                 return
 
-            # Priority 2: Main menu navigation buttons
-            if text == config.COMMANDS['menu']:
-                await self._show_main_menu(update, context, user_type)
-
-            elif text == config.BUTTONS['back']:
-                await self._handle_back_button(update, context, user_type)
-
-            elif text == config.BUTTONS['back_to_groups']:
-                await teacher_handlers.show_my_groups(update, context)
+            # Priority 2: Menu navigation and role switching buttons (one dict lookup)
+            handler = self._text_dispatch.get(text)
+            if handler:
+                await handler(update, context, user_type)
 
-            # Priority 3: Role switching for dual-role users
-            elif text == config.BUTTONS['switch_role']:
-                await self._handle_role_switch(update, context)
-
-            # Priority 4: Teacher group selection (dynamic text matching)
+            # Priority 3: Teacher group selection (dynamic text matching)
             elif user_type == 'teacher' and text.startswith('📚'):
                 await teacher_handlers.select_group(update, context)
 
-            # Priority 5: Handle unknown messages with helpful guidance
+            # Priority 4: Handle unknown messages with helpful guidance
             else:
                 await self._handle_unknown_message(update, context, user_type)
 
-        except Exception as e:
-            logger.error(f"Error handling text message: {e}")
+        except (sqlite3.Error, TelegramError) as e:
+            logger.error("Error handling text message: %s", e)
             await update.message.reply_text(config.MESSAGES['something_wrong'])
 
     async def _handle_role_switch(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -493,24 +632,9 @@ class EducationBot:
                     "ℹ️ Sizda faqat bitta rol mavjud. Rol almashtirish kerak emas."
                 )
         except Exception as e:
-            logger.error(f"Error in role switch: {e}")
+            logger.error("Error in role switch: %s", e)
             await update.message.reply_text(config.MESSAGES['something_wrong'])
 
-    async def handle_grade_input(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """
-        Special handler for numeric grade input during teacher grading workflow.
-        This ensures grades are processed correctly in the grading context.
-        """
-        user_type = context.user_data.get('user_type')
-        session = auth.get_user_session(update.effective_user.id)
-
-        # Only process grades if user is teacher and in grading session
-        if user_type == 'teacher' and session and session.get('session_type') == 'grading':
-            await teacher_handlers.receive_grade(update, context)
-        else:
-            # Not in grading context, treat as regular message
-            await self.handle_text_message(update, context)
-
     async def _show_main_menu(self, update: Update, context: ContextTypes.DEFAULT_TYPE, user_type):
         """Show the appropriate main menu based on user type"""
         if user_type == 'admin':
@@ -524,11 +648,21 @@ class EducationBot:
 
     async def _handle_back_button(self, update: Update, context: ContextTypes.DEFAULT_TYPE, user_type):
         """Handle back button navigation intelligently based on context"""
-        session = auth.get_user_session(update.effective_user.id)
-
-        if user_type == 'teacher' and session and session.get('selected_group_id'):
+        group_id = None
+        if user_type == 'teacher':
+            # Going back leaves the grading queue
+            await teacher_handlers.leave_grading(update, context)
+
+            # Selected group from user_data; the session store only for users who selected it
+            # before it was kept there
+            group_id = context.user_data.get('selected_group_id')
+            if group_id is None:
+                session = await teacher_handlers.get_session(update, context)
+                group_id = session and session.get('selected_group_id')
+
+        if group_id:
             # If teacher has a group selected, go back to group menu
-            group = auth._get_group_by_id(session['selected_group_id'])
+            group = await teacher_handlers.get_teacher_group(context.user_data.get('user_phone'), group_id)
             if group:
                 await teacher_handlers.show_group_management_menu(update, context, group)
             else:
@@ -540,30 +674,35 @@ class EducationBot:
     async def _handle_unknown_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE, user_type):
         """Provide helpful guidance for unrecognized messages"""
         if not user_type:
-            await update.message.reply_text(
-                "❓ Avval /start buyrug'ini yuboring va telefon raqamingizni tasdiqqlang."
-            )
+            await update.message.reply_text(_NOT_AUTHENTICATED_TEXT)
         else:
-            await update.message.reply_text(
-                "❓ Noma'lum buyruq. Iltimos, tugmalardan foydalaning yoki /start buyrug'ini yuboring."
-            )
+            await update.message.reply_text(_UNKNOWN_COMMAND_TEXT)
 
     async def error_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """
         Global error handler for graceful error management.
         This ensures users always get helpful feedback even when things go wrong.
         """
-        logger.error(f"Update {update} caused error {context.error}")
+        # Lazy %s formatting: the (large) Update repr is only built if the record is emitted
+        logger.error("Update %s caused error %s", update, context.error, exc_info=context.error)
 
         # Try to send a user-friendly error message
         try:
             if update and update.message:
-                await update.message.reply_text(
-                    f"{config.MESSAGES['something_wrong']}\n\n"
-                    f"Agar muammo davom etsa, /start buyrug'ini yuboring."
-                )
+                await update.message.reply_text(_ERROR_TEXT)
         except Exception as e:
-            logger.error(f"Error sending error message: {e}")
+            logger.error("Error sending error message: %s", e)
+
+    @staticmethod
+    async def _on_startup(application: Application):
+        """Runs once before the first update is fetched: create/upgrade the schema off the event loop"""
+        await asyncio.to_thread(db.init_database)
+        logger.info("📚 Ta'lim tizimi ishlamoqda!")
+
+    @staticmethod
+    async def _on_shutdown(application: Application):
+        """Runs once after the bot has stopped: refresh planner statistics and close connections"""
+        await asyncio.to_thread(db.close)
 
     def run(self):
         """
@@ -572,16 +711,24 @@ class EducationBot:
         """
         logger.info("🚀 Education Bot ishga tushmoqda...")
 
-        # Initialize database if needed
-        db.init_database()
-
-        logger.info("📚 Ta'lim tizimi ishlamoqda!")
-
-        # Start the bot with polling (good for development)
-        self.app.run_polling(
-            allowed_updates=Update.ALL_TYPES,
-            drop_pending_updates=True  # Ignore messages sent while bot was offline
-        )
+        if config.WEBHOOK_URL:
+            # Production: Telegram pushes updates to us, no getUpdates loop
+            self.app.run_webhook(
+                listen=config.WEBHOOK_LISTEN,
+                port=config.WEBHOOK_PORT,
+                # Serve on the same path Telegram is told to post to
+                url_path=urlsplit(config.WEBHOOK_URL).path.strip('/'),
+                webhook_url=config.WEBHOOK_URL,
+                secret_token=config.WEBHOOK_SECRET,
+                allowed_updates=_ALLOWED_UPDATES,
+                drop_pending_updates=True  # Ignore messages sent while bot was offline
+            )
+        else:
+            # Start the bot with polling (good for development)
+            self.app.run_polling(
+                allowed_updates=_ALLOWED_UPDATES,
+                drop_pending_updates=True  # Ignore messages sent while bot was offline
+            )
 
 
 def main():
@@ -589,6 +736,10 @@ def main():
     Application entry point.
     This starts our complete education management system.
     """
+    # Stop before building the application if required settings are missing
+    if not validate_configuration():
+        return
+
     try:
         # Create and start the education bot
         bot = EducationBot()
@@ -597,7 +748,7 @@ def main():
     except KeyboardInterrupt:
         logger.info("🛑 Bot to'xtatildi (Ctrl+C)")
     except Exception as e:
-        logger.error(f"❌ Bot xatosi: {e}")
+        logger.error("❌ Bot xatosi: %s", e)
         raise
 
 
@@ -0,0 +1,34 @@
+from telegram import InputMediaPhoto
+
+# Most photos Telegram accepts in one album (sendMediaGroup)
+TELEGRAM_ALBUM_LIMIT = 10
+
+
+def truncate(text, limit=100):
+    """Shorten text to limit characters, marking the cut with '...'"""
+    return text if len(text) <= limit else text[:limit] + '...'
+
+
+def album_count(photos):
+    """Number of API requests send_photos() makes for these photos"""
+    return -(-len(photos) // TELEGRAM_ALBUM_LIMIT)
+
+
+async def send_photos(bot, chat_id, photos, caption=None):
+    """
+    Send photos as albums of up to TELEGRAM_ALBUM_LIMIT (one request each); a lone photo
+    uses send_photo. The optional caption is attached to the first photo.
+    """
+    for i in range(0, len(photos), TELEGRAM_ALBUM_LIMIT):
+        album = photos[i:i + TELEGRAM_ALBUM_LIMIT]
+        album_caption = caption if i == 0 else None
+        if len(album) == 1:
+            await bot.send_photo(chat_id=chat_id, photo=album[0], caption=album_caption)
+        else:
+            await bot.send_media_group(
+                chat_id=chat_id,
+                media=[
+                    InputMediaPhoto(photo_id, caption=album_caption if j == 0 else None)
+                    for j, photo_id in enumerate(album)
+                ]
+            )
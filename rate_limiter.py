@@ -0,0 +1,138 @@
+import asyncio
+import functools
+import logging
+import time
+from collections import defaultdict, deque
+
+logger = logging.getLogger(__name__)
+
+# Telegram lets a bot send about 30 messages per second in total
+TELEGRAM_MESSAGES_PER_SECOND = 30
+
+
+class TokenBucket:
+    """
+    Classic token bucket: holds up to `capacity` tokens, refilled at `rate` tokens per second.
+    acquire() waits until a token is available, so bursts are smoothed to the refill rate.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+
+    async def acquire(self, tokens=1):
+        # A request for more than the bucket holds waits for a full bucket instead of forever
+        tokens = min(tokens, self.capacity)
+        while True:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+            self._updated_at = now
+
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return
+
+            await asyncio.sleep((tokens - self._tokens) / self.rate)
+
+
+class OutboundQueue:
+    """
+    FIFO queue of outgoing Telegram calls drained by one background worker.
+
+    Handlers enqueue a call and get a future back: fire-and-forget callers return right away,
+    while callers that await the future still see their own sends in order. The worker starts
+    the calls in FIFO order, taking one token from the bucket per Telegram API request the call
+    makes so the bot stays under Telegram's limit, and lets them run concurrently so one slow
+    request doesn't hold up the rest.
+    The worker task is started on first use, inside the running event loop.
+    """
+
+    def __init__(self, rate=TELEGRAM_MESSAGES_PER_SECOND):
+        self._bucket = TokenBucket(rate)
+        self._queue = None
+        self._worker = None
+        # Calls in flight; holding the tasks keeps them from being garbage-collected
+        self._in_flight = set()
+
+    def enqueue(self, func, *args, **kwargs):
+        """
+        Schedule `await func(*args, **kwargs)`, a single API request, and return a future with
+        its result. Callers that only fire a notification can ignore the future; failures are logged.
+        """
+        return self.enqueue_requests(1, func, *args, **kwargs)
+
+    def enqueue_requests(self, requests, func, *args, **kwargs):
+        """Like enqueue(), for a `func` that makes `requests` API requests (one token each)"""
+        if self._worker is None:
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.get_running_loop().create_task(self._run())
+
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((requests, func, args, kwargs, future))
+        return future
+
+    async def _run(self):
+        while True:
+            requests, func, args, kwargs, future = await self._queue.get()
+            await self._bucket.acquire(requests)
+            task = asyncio.create_task(self._call(func, args, kwargs, future))
+            self._in_flight.add(task)
+            task.add_done_callback(self._in_flight.discard)
+            self._queue.task_done()
+
+    @staticmethod
+    async def _call(func, args, kwargs, future):
+        try:
+            result = await func(*args, **kwargs)
+            if not future.cancelled():
+                future.set_result(result)
+        except Exception as e:
+            logger.exception("Error sending queued Telegram call")
+            if not future.cancelled():
+                future.set_exception(e)
+                # Nobody may be awaiting a fire-and-forget call; don't warn about it
+                future.exception()
+
+
+# Shared queue for everything the bot sends outside the reply to the current update
+outbound_queue = OutboundQueue()
+
+
+def rate_limited(max_per_minute=30):
+    """
+    Decorator for async handlers taking (update, context): each user may trigger the handler
+    at most `max_per_minute` times in any sliding 60-second window. Presses over the limit
+    get a short notice and the handler is skipped.
+    """
+    def decorator(handler):
+        # user_id -> timestamps of the presses inside the current window
+        presses = defaultdict(deque)
+        last_sweep = time.monotonic()
+
+        @functools.wraps(handler)
+        async def wrapper(update, context, *args, **kwargs):
+            nonlocal last_sweep
+            now = time.monotonic()
+
+            # Once a minute, forget users whose whole window has expired
+            if now - last_sweep >= 60:
+                for user_id in [uid for uid, times in presses.items() if not times or now - times[-1] >= 60]:
+                    del presses[user_id]
+                last_sweep = now
+
+            window = presses[update.effective_user.id]
+            while window and now - window[0] >= 60:
+                window.popleft()
+
+            if len(window) >= max_per_minute:
+                await update.message.reply_text("⏳ Juda ko'p so'rov. Biroz kutib, qaytadan urinib ko'ring.")
+                return None
+
+            window.append(now)
+            return await handler(update, context, *args, **kwargs)
+
+        return wrapper
+
+    return decorator